@@ -1,23 +1,25 @@
-from snapshot import create_average_snapshot, get_chain_and_contract
-import indexer
-from web3 import Web3, HTTPProvider
-from web3.middleware import geth_poa_middleware
 import time
 import json
-from config import load_config, get_excluded_address, get_rpc
+from config import load_config, get_excluded_address, get_chain
+from logs import log
+from metrics import instrumented
+from snapfile import checksum_address, hex_to_bytes
+import argparse
 import os
 import asyncio
 import dotenv
 import uuid
 
-cfg = load_config()
+# web3, SQLAlchemy and the indexer are imported by the functions that use
+# them, a run with nothing due returns before loading any of them
 dotenv.load_dotenv()
 
 # Constants, 1 week schedule
-CHUNK_SIZE = 100
+CHUNK_SIZE = 100  # Used when the gas of a chunk cannot be estimated
+PROBE_SIZE = 20
 SCHEDULE_INTERVAL = 604800
 MAX_RETRIES = 5
-TAX_WALLET_ADDRESS = Web3.to_checksum_address(os.getenv('TAX_WALLET_ADDRESS'))  # Address of the tax wallet
+TAX_WALLET_ADDRESS = checksum_address(hex_to_bytes(os.getenv('TAX_WALLET_ADDRESS')))  # Address of the tax wallet
 TAX_WALLET_PRIVATE_KEY = os.getenv('TAX_WALLET_PRIVATE_KEY')  # Private key of the tax wallet
 
 LAST_AIRDROPPED_BLOCKS_FILE = 'last_airdropped_blocks.json'
@@ -59,11 +61,11 @@ def set_last_run(timestamp):
 def get_abi(chain_id, contract_address):
     path = f'abi/{chain_id}_{contract_address}.abi.json'
     if os.path.isfile(path):
-        print("ABI found, using custom ABI")
+        log("ABI found, using custom ABI", path=path)
         with open(path, 'r') as file:
             return json.load(file)
     else:
-        print("ABI not found, using default ERC20 ABI\n"
+        log("ABI not found, using default ERC20 ABI\n"
             "If you want to use a custom ABI, create a file in the abi folder "
             f"with the name {chain_id}_{contract_address}.abi.json")
         with open('erc20.abi.json', 'r') as file:
@@ -71,6 +73,8 @@ def get_abi(chain_id, contract_address):
     
 
 def get_snapshot(chain_id, contract_address, end_block):
+    from snapshot import create_average_snapshot
+
     # get excluded addresses from config.yml chains->contracts->excluded_addresses
     excluded_addresses = get_excluded_address(chain_id, contract_address)
 
@@ -80,45 +84,90 @@ def get_snapshot(chain_id, contract_address, end_block):
     # return the snapshot, excluding liquidity pools
     balances = create_average_snapshot(chain_id, contract_address, start_block, end_block)
 
-    return {address: balance for address, balance in balances.items() if address not in excluded_addresses}
+    return {address: balance for address, balance in balances.items() if address.lower() not in excluded_addresses}
 
 
 def eligible_balance_for_airdrop(chain_id, contract_address):
+    from journal import get_journal
+    from rpc import make_web3
+
     abi = get_abi(chain_id, contract_address)
-    rpc = get_rpc(chain_id)
-    w3 = Web3(HTTPProvider(rpc))
-    w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    w3 = make_web3(get_chain(chain_id))
     contract = w3.eth.contract(address=contract_address, abi=abi)
 
     # Get the balance of the wallet
     current_balance = contract.functions.balanceOf(TAX_WALLET_ADDRESS).call()
-    print(f'Current balance of the wallet: {current_balance}')
-
-    transactions_file = f'{contract_address}_{chain_id}_transactions.json'
-    failed_sum = 0
+    log(f'Current balance of the wallet: {current_balance}', balance=current_balance)
 
-    # If the transaction file exists, compute the sum of failed transfers
-    if os.path.isfile(transactions_file):
-        with open(transactions_file, 'r') as file:
-            transactions_log = json.load(file)
-
-        for txn_id, txn_info in transactions_log.items():
-            if txn_info['status'] == 'failed':
-                failed_sum += sum(txn_info['balances'])
+    # Tokens of failed chunks stay reserved for their retry
+    failed_sum = get_journal(chain_id, contract_address).failed_total()
 
     # Return the balance eligible for airdrop
-    print(f'Balance eligible for airdrop: {current_balance - failed_sum}')
+    log(f'Balance eligible for airdrop: {current_balance - failed_sum}', balance=current_balance - failed_sum)
     return current_balance - failed_sum
 
 
-def distribute_airdrop(chain_id, contract_address, snapshot):
+class ChunkPlan:
+    """Chunk size and gas limits for one airdrop.
+
+    Gas is modelled as base + per_recipient * recipients, measured from two
+    estimate_gas calls with fresh addresses. A fresh address needs a new
+    storage slot, the most a recipient can cost, so real chunks stay within
+    the limit.
+    """
+
+    def __init__(self, size, base=None, per_recipient=None, margin=1.1):
+        self.size = size
+        self.base = base
+        self.per_recipient = per_recipient
+        self.margin = margin
+
+    def gas(self, recipients):
+        if self.base is None:
+            return None
+        return int((self.base + self.per_recipient * recipients) * self.margin)
+
+
+def plan_chunks(w3, contract, chain, balances, gas_price):
+    # Largest chunk whose gas fits in airdrop_gas_share of the block gas limit
+    probe = min(len(balances), PROBE_SIZE)
+    if probe < 2:
+        return ChunkPlan(max(1, probe))
+
+    def estimate(count):
+        recipients = [checksum_address(os.urandom(20)) for _ in range(count)]
+        return contract.functions.airdrop(recipients, balances[:count]).estimate_gas({'gasPrice': gas_price})
+
+    try:
+        small = estimate(probe // 2)
+        large = estimate(probe)
+        gas_limit = w3.eth.get_block('latest')['gasLimit']
+    except Exception as e:
+        log(f"Could not estimate airdrop gas, using chunks of {CHUNK_SIZE}: {str(e)}", level='warning')
+        return ChunkPlan(CHUNK_SIZE)
+
+    per_recipient = max(1, (large - small) / (probe - probe // 2))
+    base = max(0, small - per_recipient * (probe // 2))
+    plan = ChunkPlan(1, base, per_recipient)
+    budget = gas_limit * chain.get('airdrop_gas_share', 0.5) / plan.margin
+    plan.size = max(1, min(int((budget - base) / per_recipient), chain.get('airdrop_max_chunk_size', 2000)))
+    log(
+        f"Airdrop gas: {base:.0f} + {per_recipient:.0f} per recipient, {plan.size} recipients per transaction",
+        base_gas=round(base), recipient_gas=round(per_recipient), chunk_size=plan.size
+    )
+    return plan
+
+
+def distribute_airdrop(chain_id, contract_address, snapshot, retry=0):
+    from journal import get_journal
+    from rpc import make_web3
+    from txsender import PipelinedSender
+
     abi = get_abi(chain_id, contract_address)
-    rpc = get_rpc(chain_id)
-    w3 = Web3(HTTPProvider(rpc))
-    w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    chain = get_chain(chain_id)
+    w3 = make_web3(chain)
     w3.eth.default_account = TAX_WALLET_ADDRESS    
     contract = w3.eth.contract(address=contract_address, abi=abi)
-    nonce = w3.eth.get_transaction_count(TAX_WALLET_ADDRESS)
     snapshot_total = sum(snapshot.values())
     wallet_balance = eligible_balance_for_airdrop(chain_id, contract_address)
 
@@ -126,117 +175,169 @@ def distribute_airdrop(chain_id, contract_address, snapshot):
     addresses = list(snapshot.keys())
     balances = [int(snapshot[address] / snapshot_total * wallet_balance) for address in addresses]
 
-    transactions_file = f'{contract_address}_{chain_id}_transactions.json'
-
-    # Load the transactions log file if it exists, otherwise start with an empty dict.
-    if os.path.isfile(transactions_file):
-        with open(transactions_file, 'r') as file:
-            transactions_log = json.load(file)
-    else:
-        transactions_log = {}
-
-    print(f'Found {len(addresses)} addresses to send to')
+    journal = get_journal(chain_id, contract_address)
+
+    log(f'Found {len(addresses)} addresses to send to', addresses=len(addresses))
+    # Chunks go out with consecutive nonces, several waiting for receipts at once
+    sender = PipelinedSender(
+        w3,
+        chain,
+        TAX_WALLET_ADDRESS,
+        TAX_WALLET_PRIVATE_KEY,
+        max_in_flight=chain.get('airdrop_max_in_flight', 8),
+        poll_interval=chain.get('airdrop_poll_interval', 2.0),
+        replace_after=chain.get('airdrop_replace_after', 180),
+        gas_price_ttl=chain.get('airdrop_gas_price_ttl', 60),
+    )
+    plan = plan_chunks(w3, contract, chain, balances, sender.gas_price())
+    chunks = {}
     while addresses:
-        print(f'Current nonce: {nonce}')
-        chunk_addresses = addresses[:CHUNK_SIZE]
-        chunk_balances = balances[:CHUNK_SIZE]
+        # Generate a unique ID for each chunk
+        chunks[str(uuid.uuid4())] = {
+            'addresses': addresses[:plan.size],
+            'balances': balances[:plan.size],
+            'retry': retry
+        }
 
-        addresses = addresses[CHUNK_SIZE:]
-        balances = balances[CHUNK_SIZE:]
+        addresses = addresses[plan.size:]
+        balances = balances[plan.size:]
 
-        print("Building transaction...")
-        txn = contract.functions.airdrop(chunk_addresses, chunk_balances).build_transaction({
+    # Journal every chunk before the first one is sent
+    journal.add(chunks)
+
+    def build(txn_id, nonce, gas_price):
+        chunk = chunks[txn_id]
+        log(f"Building transaction for {len(chunk['addresses'])} addresses at nonce {nonce}...", chunk=txn_id, nonce=nonce)
+        params = {
             'chainId': chain_id,
-            'gasPrice': w3.eth.gas_price,
+            'gasPrice': gas_price,
             'nonce': nonce,
-        })
-
-
-        txn['gas'] = w3.eth.estimate_gas(txn)
-        print("Signing transaction...")
-        signed_txn = w3.eth.account.sign_transaction(txn, TAX_WALLET_PRIVATE_KEY)
-        print("Signed transaction!")
-        print(f'Sending to {len(chunk_addresses)} addresses...')
-        
-        # Generate a unique ID for this transaction
-        txn_id = str(uuid.uuid4())
-        transactions_log[txn_id] = {
-            'status': 'pending',
-            'addresses': chunk_addresses,
-            'balances': chunk_balances,
-            'transaction_hash': None,
-            'retry': 0
         }
-        
-        try:
-            txn_hash = w3.eth.send_raw_transaction(signed_txn.rawTransaction)
-            transactions_log[txn_id]['transaction_hash'] = txn_hash.hex()
-            
-            receipt = w3.eth.wait_for_transaction_receipt(txn_hash)
-
-            # Check transaction status
-            if receipt['status'] == 0:
-                print("Transaction failed!")
-                transactions_log[txn_id]['status'] = 'failed'
-                continue
-            else:
-                print("Transaction successful!")
-                transactions_log[txn_id]['status'] = 'success'
-
-        except Exception as e:
-            print(f"Failed to send transaction: {str(e)}")
-            transactions_log[txn_id]['status'] = 'failed'
-            transactions_log[txn_id]['retry'] += 1
-            continue
-
-        nonce += 1
-
-        # Save the transactions log after each transaction
-        with open(transactions_file, 'w') as file:
-            json.dump(transactions_log, file)
+        # With a gas limit from the plan, building makes no RPC calls
+        gas = plan.gas(len(chunk['addresses']))
+        if gas is not None:
+            params['gas'] = gas
+        return contract.functions.airdrop(chunk['addresses'], chunk['balances']).build_transaction(params)
+
+    def record(txn_id, status, txn_hash):
+        if status == 'pending':
+            journal.add_transaction(txn_id, txn_hash)
+        else:
+            journal.set_status([txn_id], status, failed=status == 'failed')
+
+    sender.run(list(chunks), build, record)
+
+
+def reconcile_transactions(chain_id, journal):
+    from rpc import get_receipts
+
+    # Chunks an interrupted run never got to send
+    unsent = journal.unsent()
+    if unsent:
+        journal.set_status(unsent, 'failed')
+
+    # A chunk marked failed because waiting for its receipt timed out may
+    # still have been mined, so check every sent chunk before retrying it.
+    # Only the chunk's own transactions are checked, never a cancellation
+    # that took its nonce. The receipts come back in a handful of batched
+    # requests.
+    unsettled = journal.unsettled()
+    if not unsettled:
+        return
+
+    sent = [(txn_id, txn_hash) for txn_id, hashes in unsettled for txn_hash in hashes]
+    receipts = get_receipts(get_chain(chain_id), [txn_hash for _, txn_hash in sent])
+    mined = list(dict.fromkeys(
+        txn_id for (txn_id, _), receipt in zip(sent, receipts) if receipt is not None and receipt['status'] == 1
+    ))
+    for txn_id in mined:
+        log(f'Transaction {txn_id} was mined after all', chunk=txn_id)
+    if mined:
+        journal.set_status(mined, 'success')
+
+    # A chunk still pending from an earlier run is failed once none of its
+    # transactions can be mined anymore: the node dropped them all, or the
+    # nonce they share went to another transaction
+    chain = get_chain(chain_id)
+    stale = [
+        (txn_id, hashes) for txn_id, hashes in journal.pending(time.time() - chain.get('airdrop_replace_after', 180))
+        if txn_id not in mined
+    ]
+    if not stale:
+        return
+    from rpc import get_transactions, make_web3
+
+    transactions = get_transactions(chain, [txn_hash for _, hashes in stale for txn_hash in hashes])
+    nonce = make_web3(chain).eth.get_transaction_count(TAX_WALLET_ADDRESS)
+    lost = []
+    for txn_id, hashes in stale:
+        known, transactions = transactions[:len(hashes)], transactions[len(hashes):]
+        if all(transaction is None or int(transaction['nonce'], 16) < nonce for transaction in known):
+            log(f'Transaction {txn_id} can no longer be mined, marking it failed', level='warning', chunk=txn_id)
+            lost.append(txn_id)
+    if lost:
+        journal.set_status(lost, 'failed', failed=True)
 
 
 def retry_failed_chunks(chain_id, contract_address):
-    transactions_file = f'{contract_address}_{chain_id}_transactions.json'
-    if os.path.isfile(transactions_file):
-        with open(transactions_file, 'r') as file:
-            transactions_log = json.load(file)
-
-        for txn_id, txn_info in transactions_log.items():
-            if txn_info['status'] == 'failed' and txn_info['retry'] < MAX_RETRIES:
-                print(f'Retrying transaction {txn_id}')
-                distribute_airdrop(chain_id, contract_address, dict(zip(txn_info['addresses'], txn_info['balances'])))
-            elif txn_info['status'] == 'failed' and txn_info['retry'] >= MAX_RETRIES:
-                print(f'Failed to send transaction {txn_id} after {MAX_RETRIES} attempts')
-    else:
-        print('No transaction log file found.')
+    from journal import get_journal
+
+    journal = get_journal(chain_id, contract_address)
+    reconcile_transactions(chain_id, journal)
+
+    for txn_info in journal.chunks('failed'):
+        if txn_info['retry'] < MAX_RETRIES:
+            log(f"Retrying transaction {txn_info['id']}", chunk=txn_info['id'], retry=txn_info['retry'])
+            distribute_airdrop(
+                chain_id,
+                contract_address,
+                dict(zip(txn_info['addresses'], txn_info['balances'])),
+                retry=txn_info['retry']
+            )
+            # Its recipients are in new chunks now, which carry the retry count
+            journal.set_status([txn_info['id']], 'retried')
+        else:
+            log(f"Failed to send transaction {txn_info['id']} after {MAX_RETRIES} attempts", level='error', chunk=txn_info['id'])
 
 
 def run_snapshot_and_airdrop():
-    for chain in cfg['chains']:
+    import indexer
+
+    for chain in load_config()['chains']:
         for contract in chain['contracts']:
             retry_failed_chunks(chain['id'], contract['address'])
-            print(f'Running snapshot and airdrop for {contract["address"]} on chain {chain["id"]}')
+            log(f'Running snapshot and airdrop for {contract["address"]} on chain {chain["id"]}', chain=chain['id'], contract=contract['address'])
             endblock = indexer.get_last_processed_block(chain['id'], contract['address'])
             snapshot = get_snapshot(chain['id'], contract['address'], endblock)
             distribute_airdrop(chain['id'], contract['address'], snapshot)
             set_last_airdropped_block(chain['id'], contract['address'], endblock)
 
 
-if(__name__ == '__main__'):
+def run():
     # update the indexer if we haven't done so in a while
     last_run = get_last_run()
     if time.time() - last_run > 3600:
-        print('Updating indexer...')
+        import indexer
+
+        log('Updating indexer...')
         asyncio.run(indexer.index())
     else:
-        print('Indexer is up to date.')
+        log('Indexer is up to date.')
 
     # run the snapshot for each chain and performe the airdrop
     if time.time() - last_run > SCHEDULE_INTERVAL:
-        print('Running snapshot and airdrop...')
+        log('Running snapshot and airdrop...')
         run_snapshot_and_airdrop()
         set_last_run(time.time())
     else:
-        print('Airdrop is not scheduled yet.')
+        log('Airdrop is not scheduled yet.')
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description="Update the indexer, then snapshot and airdrop every contract when due.")
+    parser.add_argument('--profile', help="write cProfile stats of the run to this file")
+    args = parser.parse_args()
+
+    with instrumented(load_config(), args.profile):
+        run()
     
\ No newline at end of file
@@ -0,0 +1,229 @@
+"""Vectorized balance replay with NumPy.
+
+Does the same work as checkpoints.replay_balances and
+snapshot.TimeWeightedBalances, a whole batch of events at a time.
+
+Holders get dense slots in the order they first appear, and the 256-bit
+values are split into sixteen 16-bit limbs, most significant first. Each
+batch is applied with one scatter-add per limb column: plain values into the
+balance sums and values times the block offset into the weighted sums. The
+accumulators are int64 columns, so limbs are allowed to grow past 16 bits
+and the carries are only pushed up when results are read back, where the
+limbs are joined into Python ints. Results are exactly those of the Python
+replay.
+
+A column holds at most 2**32 per event, which keeps the sums exact for
+fewer than 2**31 events per holder. Block offsets from the origin must stay
+below 2**32.
+"""
+from collections import defaultdict, deque
+import numpy as np
+from sqlalchemy import select
+from checkpoints import nearest_checkpoint, unpack_balances
+from database import Event
+
+LIMB_BITS = 16
+LIMBS = 256 // LIMB_BITS
+LIMB_MASK = (1 << LIMB_BITS) - 1
+TOP_SHIFT = LIMB_BITS * (LIMBS - 1)
+
+BATCH_SIZE = 200000
+
+
+def to_limbs(values):
+    # 32-byte big-endian values to an (n, LIMBS) array of 16-bit limbs
+    packed = b''.join(values)
+    if len(packed) != len(values) * 32:
+        raise ValueError("event values must be 32 bytes each")
+    return np.frombuffer(packed, dtype='>u2').reshape(-1, LIMBS)
+
+
+def to_ints(limbs):
+    """Join limb sums, one row per holder, into Python ints.
+
+    Carries go up limb by limb, leaving every limb below the top one in
+    [0, 2**16). The top limb keeps the sign and anything past 256 bits.
+    """
+    limbs = np.array(limbs, dtype=np.int64)
+    for k in range(LIMBS - 1, 0, -1):
+        limbs[:, k - 1] += limbs[:, k] >> LIMB_BITS
+        limbs[:, k] &= LIMB_MASK
+
+    # One bytes object per row for the limbs below the top one
+    low = np.ascontiguousarray(limbs[:, 1:].astype('>u2')).view(f'V{2 * (LIMBS - 1)}').ravel().tolist()
+    return [
+        (top << TOP_SHIFT) + int.from_bytes(rest, 'big') if top else int.from_bytes(rest, 'big')
+        for top, rest in zip(limbs[:, 0].tolist(), low)
+    ]
+
+
+def to_batch(rows):
+    # (block_number, from_id, to_id, value) rows to one batch of arrays
+    count = len(rows)
+    return (
+        np.fromiter((row[0] for row in rows), dtype=np.int64, count=count),
+        np.fromiter((row[1] for row in rows), dtype=np.int64, count=count),
+        np.fromiter((row[2] for row in rows), dtype=np.int64, count=count),
+        to_limbs([row[3] for row in rows]),
+    )
+
+
+def event_batches(db_session, contract_id, after_block, upto_block, batch_size=BATCH_SIZE):
+    """Yield events in (after_block, upto_block] as arrays, in order.
+
+    Each batch is (block_numbers, from_ids, to_ids, limbs).
+    """
+    query = select(Event.block_number, Event.from_id, Event.to_id, Event.value).where(
+        Event.contract_id == contract_id,
+        Event.block_number > after_block,
+        Event.block_number <= upto_block
+    ).order_by(Event.block_number, Event.log_index).execution_options(yield_per=batch_size)
+
+    for partition in db_session.execute(query).partitions():
+        yield to_batch(partition)
+
+
+class LimbBalances:
+    """Balances and their sums over blocks after origin, kept as limb columns.
+
+    initial holds the balances after origin as Python ints. balances and
+    integral(block) give the same results as TimeWeightedBalances.
+    """
+
+    def __init__(self, initial, origin, weighted=True):
+        self.initial = initial
+        self.origin = origin
+        self.weighted = weighted
+        self.slots = np.full(0, -1, dtype=np.int64)
+        self.holders = np.zeros(0, dtype=np.int64)
+        self.count = 0
+        # Limb-major: one contiguous column per limb, one entry per slot
+        self.sums = np.zeros((LIMBS, 0), dtype=np.int64)
+        self.low_weighted = np.zeros((LIMBS, 0), dtype=np.int64)
+        self.high_weighted = np.zeros((LIMBS, 0), dtype=np.int64)
+
+    def slots_for(self, holder_ids):
+        # Dense slots for address ids, new holders get the next free ones
+        if len(holder_ids) and holder_ids.max() >= len(self.slots):
+            grown = np.full(max(2 * len(self.slots), holder_ids.max() + 1), -1, dtype=np.int64)
+            grown[:len(self.slots)] = self.slots
+            self.slots = grown
+
+        slots = self.slots[holder_ids]
+        new = np.unique(holder_ids[slots < 0])
+        if len(new):
+            self.reserve(self.count + len(new))
+            self.slots[new] = np.arange(self.count, self.count + len(new))
+            self.holders[self.count:self.count + len(new)] = new
+            self.count += len(new)
+            slots = self.slots[holder_ids]
+        return slots
+
+    def reserve(self, size):
+        capacity = self.sums.shape[1]
+        if size <= capacity:
+            return
+        capacity = max(2 * capacity, size, 1024)
+
+        def grow(array):
+            grown = np.zeros(array.shape[:-1] + (capacity,), dtype=array.dtype)
+            grown[..., :array.shape[-1]] = array
+            return grown
+
+        self.holders = grow(self.holders)
+        self.sums = grow(self.sums)
+        if self.weighted:
+            self.low_weighted = grow(self.low_weighted)
+            self.high_weighted = grow(self.high_weighted)
+
+    def apply(self, block_numbers, from_ids, to_ids, limbs):
+        if not len(block_numbers):
+            return
+        senders = self.slots_for(from_ids)
+        receivers = self.slots_for(to_ids)
+
+        # Leading limbs that are zero across the whole batch add nothing
+        used = np.flatnonzero(limbs.any(axis=0))
+        if not len(used):
+            return
+
+        if self.weighted:
+            offsets = block_numbers - self.origin
+            if offsets.max() >> 32:
+                raise ValueError(f"blocks more than 2**32 after {self.origin}")
+            low_offsets = offsets & LIMB_MASK
+            high_offsets = offsets >> LIMB_BITS
+            has_high = bool(high_offsets.any())
+
+        for k in range(used[0], LIMBS):
+            column = limbs[:, k].astype(np.int64)
+            np.add.at(self.sums[k], receivers, column)
+            np.subtract.at(self.sums[k], senders, column)
+            if self.weighted:
+                weighted = column * low_offsets
+                np.add.at(self.low_weighted[k], receivers, weighted)
+                np.subtract.at(self.low_weighted[k], senders, weighted)
+                if has_high:
+                    weighted = column * high_offsets
+                    np.add.at(self.high_weighted[k], receivers, weighted)
+                    np.subtract.at(self.high_weighted[k], senders, weighted)
+
+    def replay(self, batches, marks, record):
+        """Apply batches, calling record(mark) once every event up to mark is in."""
+        pending = deque(marks)
+        for block_numbers, from_ids, to_ids, limbs in batches:
+            start = 0
+            while pending and pending[0] < block_numbers[-1]:
+                stop = int(np.searchsorted(block_numbers, pending[0], side='right'))
+                self.apply(block_numbers[start:stop], from_ids[start:stop], to_ids[start:stop], limbs[start:stop])
+                start = stop
+                record(pending.popleft())
+            self.apply(block_numbers[start:], from_ids[start:], to_ids[start:], limbs[start:])
+        while pending:
+            record(pending.popleft())
+
+    def deltas(self, array):
+        # Per slot sums as ints
+        return to_ints(array[:, :self.count].T)
+
+    @property
+    def balances(self):
+        balances = defaultdict(int, self.initial)
+        for holder, delta in zip(self.holders[:self.count].tolist(), self.deltas(self.sums)):
+            balances[holder] += delta
+        return balances
+
+    def integral(self, block):
+        # Sum of each balance over blocks origin + 1 to block, with every event
+        # up to block applied. An event at block b counts for blocks b to block:
+        # initial * (block - origin) + sum(value * (block - b + 1))
+        span = block - self.origin
+        totals = {holder: balance * span for holder, balance in self.initial.items()}
+        holders = self.holders[:self.count].tolist()
+        weighted = self.deltas(self.low_weighted)
+        if self.high_weighted[:, :self.count].any():
+            weighted = [low + (high << LIMB_BITS) for low, high in zip(weighted, self.deltas(self.high_weighted))]
+        for holder, delta, offset_sum in zip(holders, self.deltas(self.sums), weighted):
+            totals[holder] = totals.get(holder, 0) + delta * (span + 1) - offset_sum
+        return totals
+
+
+def replay_balances(db_session, contract_id, block_height):
+    # Same as checkpoints.replay_balances
+    checkpoint = nearest_checkpoint(db_session, contract_id, block_height)
+    if checkpoint is None:
+        initial, after_block = {}, -1
+    else:
+        initial, after_block = dict(unpack_balances(checkpoint.balances)), checkpoint.block_number
+
+    replay = LimbBalances(initial, after_block, weighted=False)
+    for batch in event_batches(db_session, contract_id, after_block, block_height):
+        replay.apply(*batch)
+    return replay.balances
+
+
+def time_weighted_totals(balances, batches, start_block, end_block):
+    # Same as snapshot.time_weighted_totals, balances is not updated
+    replay = LimbBalances(dict(balances), start_block)
+    replay.replay(batches, [end_block], lambda block: None)
+    return replay.integral(end_block)
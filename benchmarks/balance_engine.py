@@ -0,0 +1,128 @@
+"""Compare the Python and NumPy balance replays on synthetic transfers.
+
+Both engines get the same rows, as the database would return them, and
+replay them from a common origin with a snapshot mark halfway. The balances
+and time-weighted sums at both marks must match exactly.
+
+    python benchmarks/balance_engine.py --transfers 10000000
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+from balances_np import LimbBalances, to_batch
+from snapshot import TimeWeightedBalances
+
+
+def synthetic_batches(transfers, holders, blocks, batch_size, seed):
+    """Yield lists of (block_number, from_id, to_id, value) rows in block order.
+
+    Holders are skewed so a few addresses see most of the transfers, like
+    pools and exchanges do. Most values are 18-decimal amounts, a few use all
+    256 bits so the carries get exercised.
+    """
+    rng = np.random.default_rng(seed)
+    per_block = transfers / blocks
+    first_block = 0
+    for start in range(0, transfers, batch_size):
+        count = min(batch_size, transfers - start)
+        last_block = int((start + count) / per_block)
+        block_numbers = np.sort(rng.integers(first_block, last_block + 1, count))
+        first_block = last_block
+        from_ids = (holders * rng.random(count) ** 3).astype(np.int64) + 1
+        to_ids = (holders * rng.random(count) ** 3).astype(np.int64) + 1
+
+        limbs = rng.integers(0, 1 << 16, (count, 16), dtype=np.uint16)
+        significant = rng.choice([4, 6, 8, 16], size=count, p=[0.3, 0.5, 0.19, 0.01])
+        limbs[np.arange(16) < 16 - significant[:, None]] = 0
+        packed = limbs.astype('>u2').tobytes()
+        values = [packed[offset:offset + 32] for offset in range(0, len(packed), 32)]
+
+        yield list(zip(block_numbers.tolist(), from_ids.tolist(), to_ids.tolist(), values))
+
+
+class Timed:
+    """Iterates the synthetic rows and adds up the time spent generating them."""
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.generating = 0.0
+
+    def __iter__(self):
+        while True:
+            started = time.perf_counter()
+            rows = next(self.batches, None)
+            self.generating += time.perf_counter() - started
+            if rows is None:
+                return
+            yield rows
+
+
+def run_python(batches, origin, marks):
+    replay = TimeWeightedBalances(defaultdict(int), origin)
+    results = {}
+
+    def record(mark):
+        results[mark] = (dict(replay.balances), replay.integral(mark))
+
+    pending = list(marks)
+    for rows in batches:
+        for block_number, from_id, to_id, value in rows:
+            while pending and pending[0] < block_number:
+                record(pending.pop(0))
+            replay.apply(block_number, from_id, to_id, value)
+    for mark in pending:
+        record(mark)
+    return results
+
+
+def run_numpy(batches, origin, marks):
+    # Converting the rows to arrays is part of the engine's cost
+    replay = LimbBalances({}, origin)
+    results = {}
+
+    def record(mark):
+        results[mark] = (dict(replay.balances), replay.integral(mark))
+
+    replay.replay((to_batch(rows) for rows in batches), marks, record)
+    return results
+
+
+def timed_run(engine, rows, origin, marks):
+    batches = Timed(rows)
+    started = time.perf_counter()
+    results = engine(batches, origin, marks)
+    return results, time.perf_counter() - started - batches.generating
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Python and NumPy balance replays.")
+    parser.add_argument('--transfers', type=int, default=10_000_000)
+    parser.add_argument('--holders', type=int, default=1_000_000)
+    parser.add_argument('--blocks', type=int, default=2_000_000)
+    parser.add_argument('--batch-size', type=int, default=200_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    origin = -1
+    marks = [args.blocks // 2, args.blocks]
+
+    def rows():
+        return synthetic_batches(args.transfers, args.holders, args.blocks, args.batch_size, args.seed)
+
+    print(f"{args.transfers} transfers between up to {args.holders} holders over {args.blocks} blocks")
+    numpy_results, numpy_time = timed_run(run_numpy, rows(), origin, marks)
+    print(f"numpy:  {numpy_time:8.2f}s  {args.transfers / numpy_time:12,.0f} transfers/s")
+    python_results, python_time = timed_run(run_python, rows(), origin, marks)
+    print(f"python: {python_time:8.2f}s  {args.transfers / python_time:12,.0f} transfers/s")
+    print(f"speedup: {python_time / numpy_time:.1f}x")
+
+    for mark in marks:
+        if numpy_results[mark] != python_results[mark]:
+            sys.exit(f"Results differ at block {mark}")
+    print("Balances and time-weighted sums are identical")
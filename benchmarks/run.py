@@ -0,0 +1,337 @@
+"""Reproducible benchmarks against a local mock node.
+
+    python benchmarks/run.py --holders 10000 --blocks 20000 --events-per-block 5
+
+Builds a synthetic Transfer history (benchmarks/synthetic.py), serves it
+from a mockrpc.MockNode and measures, each phase in a fresh process so
+memory peaks do not carry over:
+
+- index: indexer.index() over the whole history, events per second and RPC traffic
+- snapshot: a single snapshot at the last block and an average snapshot over
+  the whole history, for each available engine, time and peak memory
+- airdrop: distribute_airdrop of the average snapshot, wall time and transactions
+
+Every file lives in a scratch directory, pointed to through EVENTS_DB and
+CONFIG_FILE. Results are written as JSON, by default to
+benchmarks/results/<commit>.json, and --compare prints the change against
+an earlier results file.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+CHAIN_ID = 250
+PHASES = ('index', 'snapshot', 'airdrop')
+
+AIRDROP_ABI = [
+    {
+        'name': 'balanceOf', 'type': 'function', 'stateMutability': 'view',
+        'inputs': [{'name': 'account', 'type': 'address'}],
+        'outputs': [{'name': '', 'type': 'uint256'}],
+    },
+    {
+        'name': 'airdrop', 'type': 'function', 'stateMutability': 'nonpayable',
+        'inputs': [{'name': 'recipients', 'type': 'address[]'}, {'name': 'amounts', 'type': 'uint256[]'}],
+        'outputs': [],
+    },
+]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB everywhere else
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, round(time.perf_counter() - started, 3)
+
+
+def bench_index(options):
+    import asyncio
+    import sqlite3
+    import database
+    import indexer
+
+    _, seconds = timed(asyncio.run, indexer.index())
+    conn = sqlite3.connect(database.DB_PATH)
+    events = conn.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+    conn.close()
+    return {'seconds': seconds, 'events': events, 'events_per_second': round(events / seconds)}
+
+
+def bench_single_snapshot(options):
+    import snapshot
+    balances, seconds = timed(
+        snapshot.create_single_snapshot, CHAIN_ID, options['token'], options['end_block'], engine=options['engine']
+    )
+    return {'seconds': seconds, 'holders': len(balances)}
+
+
+def bench_average_snapshot(options):
+    import snapshot
+    balances, seconds = timed(
+        snapshot.create_average_snapshot, CHAIN_ID, options['token'], 0, options['end_block'], engine=options['engine']
+    )
+    return {'seconds': seconds, 'holders': len(balances)}
+
+
+def bench_airdrop(options):
+    import airdrop
+    import snapshot
+    from journal import get_journal
+
+    balances = snapshot.create_average_snapshot(CHAIN_ID, options['token'], 0, options['end_block'])
+    _, seconds = timed(airdrop.distribute_airdrop, CHAIN_ID, options['token'], balances)
+    journal = get_journal(CHAIN_ID, options['token'])
+    return {
+        'seconds': seconds,
+        'recipients': len(balances),
+        'transactions': len(journal.chunks('pending', 'success', 'failed')),
+        'succeeded': len(journal.chunks('success')),
+    }
+
+
+BENCHMARKS = {
+    'index': bench_index,
+    'single_snapshot': bench_single_snapshot,
+    'average_snapshot': bench_average_snapshot,
+    'airdrop': bench_airdrop,
+}
+
+
+def child(name, options, queue):
+    os.chdir(options['workdir'])
+    if not options['verbose']:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        result = BENCHMARKS[name](options)
+        result['peak_rss_mb'] = peak_rss_mb()
+        queue.put(result)
+    except BaseException:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run_benchmark(name, options, node=None):
+    # One benchmark in a fresh interpreter, the node keeps serving from here
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    requests, calls, errors = (node.requests, node.calls, node.errors) if node else (0, 0, 0)
+    process = context.Process(target=child, args=(name, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise Exception(f"{name} benchmark failed:\n{result['error']}")
+    if node:
+        result['http_requests'] = node.requests - requests
+        result['rpc_calls'] = node.calls - calls
+        result['injected_errors'] = node.errors - errors
+    return result
+
+
+def write_config(workdir, url, token, options):
+    import yaml
+    config = {
+        'chains': [{
+            'id': CHAIN_ID,
+            'name': 'Synthetic',
+            'rpc_url': url,
+            'rpc_batch_size': options['rpc_batch_size'],
+            'rpc_concurrency': options['rpc_concurrency'],
+            'chunk_size': options['chunk_size'],
+            'max_chunk_size': options['chunk_size'] * 10,
+            'fetch_mode': 'chain',
+            'confirmations': 0,
+            'poll_interval': 0.2,
+            'airdrop_poll_interval': 0.25,
+            'airdrop_replace_after': options['replace_after'],
+            'contracts': [{
+                'name': 'SYN',
+                'address': token,
+                'startblock': options['start_block'],
+                'excluded_addresses': [],
+            }],
+        }],
+    }
+    with open(os.path.join(workdir, 'config.yml'), 'w') as file:
+        yaml.safe_dump(config, file, sort_keys=False)
+
+    # The indexer and airdrop read their ABIs from the working directory
+    shutil.copy(os.path.join(REPO, 'erc20.abi.json'), workdir)
+    os.makedirs(os.path.join(workdir, 'abi'), exist_ok=True)
+    with open(os.path.join(workdir, 'abi', f'{CHAIN_ID}_{token}.abi.json'), 'w') as file:
+        json.dump(AIRDROP_ABI, file)
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def compare(previous, current):
+    before = dict(flatten(previous['results']))
+    for metric, value in flatten(current['results']):
+        if metric in before and before[metric]:
+            change = (value - before[metric]) / before[metric] * 100
+            print(f"{metric:45} {before[metric]:>14} -> {value:<14} {change:+.1f}%")
+
+
+def run(args):
+    from eth_account import Account
+    from web3 import Web3
+    from mockrpc import MockNode
+    from synthetic import TransferHistory, token_address
+
+    phases = args.phases.split(',')
+    unknown = set(phases) - set(PHASES)
+    if unknown:
+        raise SystemExit(f"Unknown phases: {', '.join(sorted(unknown))}")
+
+    try:
+        import numpy  # noqa: F401
+        engines = ['numpy', 'python']
+    except ImportError:
+        engines = ['python']
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='erc20-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    # Inherited by the benchmark processes, the parent never opens either file
+    os.environ['EVENTS_DB'] = os.path.join(workdir, 'events.db')
+    os.environ['CONFIG_FILE'] = os.path.join(workdir, 'config.yml')
+
+    wallet = Account.from_key(Web3.keccak(text=f"wallet:{args.seed}"))
+    os.environ['TAX_WALLET_ADDRESS'] = wallet.address
+    os.environ['TAX_WALLET_PRIVATE_KEY'] = Web3.to_hex(wallet.key)
+
+    token = token_address(0, args.seed)
+    history = TransferHistory(
+        holders=args.holders, blocks=args.blocks, events_per_block=args.events_per_block,
+        alpha=args.alpha, seed=args.seed
+    )
+    node = MockNode(
+        chain_id=CHAIN_ID, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        drop_rate=args.drop_rate, block_time=args.block_time, seed=args.seed
+    )
+    print(f"Generating {args.blocks} blocks of transfers between {args.holders} holders...")
+    transfers = history.populate(node, token)
+    node.set_balance(token, wallet.address, 10**30)
+    url = node.start()
+
+    options = {
+        'workdir': workdir,
+        'verbose': args.verbose,
+        'token': token,
+        'start_block': history.start_block,
+        'end_block': history.end_block,
+        'chunk_size': args.chunk_size,
+        'rpc_batch_size': args.rpc_batch_size,
+        'rpc_concurrency': args.rpc_concurrency,
+        'replace_after': args.replace_after,
+    }
+    write_config(workdir, url, token, options)
+
+    results = {}
+    try:
+        # Every other phase reads the database the indexer writes
+        print(f"Indexing {transfers} transfers...")
+        results['index'] = run_benchmark('index', options, node)
+
+        if 'snapshot' in phases:
+            results['snapshot'] = {}
+            for engine in engines:
+                print(f"Snapshots with the {engine} engine...")
+                results['snapshot'][engine] = {
+                    kind: run_benchmark(f'{kind}_snapshot', dict(options, engine=engine))
+                    for kind in ('single', 'average')
+                }
+
+        if 'airdrop' in phases:
+            print("Airdropping the average snapshot...")
+            results['airdrop'] = run_benchmark('airdrop', options, node)
+    finally:
+        node.stop()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': current_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            key: value for key, value in vars(args).items()
+            if key not in ('output', 'compare', 'workdir', 'keep', 'verbose')
+        },
+        'transfers': transfers,
+        'results': results,
+    }
+
+    output = args.output or os.path.join(REPO, 'benchmarks', 'results', f"{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark indexing, snapshots and airdrops against a mock node.")
+    parser.add_argument('--holders', type=int, default=10000)
+    parser.add_argument('--blocks', type=int, default=20000)
+    parser.add_argument('--events-per-block', type=float, default=5.0)
+    parser.add_argument('--alpha', type=float, default=1.1, help="Zipf exponent of holder activity")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every RPC request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of RPC requests answered with HTTP 429")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="share of airdrop transactions never mined")
+    parser.add_argument('--block-time', type=float, default=0.5, help="seconds before a sent transaction is mined")
+    parser.add_argument('--replace-after', type=float, default=5.0, help="seconds before a dropped transaction is replaced")
+    parser.add_argument('--chunk-size', type=int, default=2000)
+    parser.add_argument('--rpc-batch-size', type=int, default=20)
+    parser.add_argument('--rpc-concurrency', type=int, default=16)
+    parser.add_argument('--phases', default=','.join(PHASES), help="comma separated, indexing always runs")
+    parser.add_argument('--output', help="results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--workdir', help="keep the database and config here instead of a scratch directory")
+    parser.add_argument('--keep', action='store_true', help="do not delete the scratch directory")
+    parser.add_argument('--verbose', action='store_true', help="show the output of the benchmarked code")
+    run(parser.parse_args())
@@ -0,0 +1,67 @@
+"""Synthetic ERC20 Transfer histories.
+
+Transfers arrive as a Poisson process of events_per_block per block. Both
+sides of a transfer are drawn from holders with Zipf weights, rank ** -alpha,
+so a few addresses, like pools and exchanges, take part in most transfers
+while the long tail of holders shows up a handful of times. Amounts are
+log-normal around 100 tokens of 18 decimals. mint_share of the transfers
+come from the zero address.
+
+Everything is derived from seed, the same arguments give the same history.
+"""
+import itertools
+import random
+from web3 import Web3
+
+ZERO_ADDRESS = '0x' + '0' * 40
+
+
+def holder_addresses(count, seed=1):
+    return [
+        Web3.to_checksum_address(Web3.keccak(text=f"holder:{seed}:{index}")[-20:])
+        for index in range(count)
+    ]
+
+
+def token_address(index, seed=1):
+    return Web3.to_checksum_address(Web3.keccak(text=f"token:{seed}:{index}")[-20:])
+
+
+class TransferHistory:
+    def __init__(self, holders=10000, blocks=10000, events_per_block=5.0, alpha=1.1,
+                 mint_share=0.01, start_block=1, seed=1):
+        self.holders = holder_addresses(holders, seed)
+        self.blocks = blocks
+        self.events_per_block = events_per_block
+        self.alpha = alpha
+        self.mint_share = mint_share
+        self.start_block = start_block
+        self.seed = seed
+        self.cum_weights = list(itertools.accumulate(rank ** -alpha for rank in range(1, holders + 1)))
+
+    @property
+    def end_block(self):
+        return self.start_block + self.blocks - 1
+
+    def transfers(self):
+        """Yield (block_number, sender, receiver, value) in block order."""
+        rng = random.Random(self.seed)
+        clock = 0.0
+        while True:
+            clock += rng.expovariate(self.events_per_block)
+            if clock >= self.blocks:
+                return
+            sender, receiver = rng.choices(self.holders, cum_weights=self.cum_weights, k=2)
+            if rng.random() < self.mint_share:
+                sender = ZERO_ADDRESS
+            value = int(rng.lognormvariate(0, 2.0) * 10**20) + 1
+            yield self.start_block + int(clock), sender, receiver, value
+
+    def populate(self, node, token):
+        # Load every transfer into a mockrpc.MockNode, returns the count
+        count = 0
+        for block_number, sender, receiver, value in self.transfers():
+            node.add_transfer(block_number, token, sender, receiver, value)
+            count += 1
+        node.head = max(node.head, self.end_block)
+        return count
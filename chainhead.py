@@ -0,0 +1,69 @@
+import asyncio
+import random
+import time
+from logs import log
+
+
+class HeadTracker:
+    """Latest block number of one chain, shared by every contract on it.
+
+    latest() only asks the node when the cached value is older than
+    poll_interval. In follow mode start() keeps polling in the background,
+    backing off exponentially while the node errors, and wait_beyond()
+    wakes contracts as soon as a new block shows up.
+    """
+
+    def __init__(self, fetch_head, poll_interval=2.0, max_backoff=60.0):
+        self.fetch_head = fetch_head
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.head = None
+        self.updated = 0.0
+        self.changed = asyncio.Condition()
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    async def refresh(self):
+        head = await self.fetch_head()
+        async with self.changed:
+            if self.head is None or head > self.head:
+                self.head = head
+                self.changed.notify_all()
+            self.updated = time.monotonic()
+        return self.head
+
+    async def latest(self):
+        # One request per poll interval, however many contracts are asking
+        async with self.lock:
+            if self.head is None or time.monotonic() - self.updated >= self.poll_interval:
+                await self.refresh()
+            return self.head
+
+    async def wait_beyond(self, block):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.head is not None and self.head > block)
+            return self.head
+
+    async def poll(self):
+        delay = self.poll_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+                delay = self.poll_interval
+            except Exception as exc:
+                delay = min(self.max_backoff, delay * 2) * random.uniform(0.8, 1.2)
+                log(f"Error polling chain head, retrying in {delay:.1f}s: {exc}", level='error', retry_in=round(delay, 1))
+
+    async def start(self):
+        await self.latest()
+        self.task = asyncio.ensure_future(self.poll())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
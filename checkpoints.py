@@ -0,0 +1,126 @@
+import struct
+import zlib
+from collections import defaultdict
+from sqlalchemy import func, select
+from database import decode_value, BalanceCheckpoint, Event
+
+HOLDER = struct.Struct('>Q')
+RECORD_SIZE = HOLDER.size + 32
+
+STREAM_BATCH_SIZE = 10000
+
+
+def pack_balances(balances):
+    # Holder id followed by the signed 256-bit balance, zero balances dropped.
+    # Balances can go negative for the mint source, hence signed.
+    packed = b''.join(
+        HOLDER.pack(holder) + balance.to_bytes(32, 'big', signed=True)
+        for holder, balance in balances.items() if balance
+    )
+    return zlib.compress(packed)
+
+
+def unpack_balances(blob):
+    packed = zlib.decompress(blob)
+    balances = defaultdict(int)
+    for offset in range(0, len(packed), RECORD_SIZE):
+        holder, = HOLDER.unpack_from(packed, offset)
+        balances[holder] = int.from_bytes(packed[offset + HOLDER.size:offset + RECORD_SIZE], 'big', signed=True)
+    return balances
+
+
+def nearest_checkpoint(db_session, contract_id, block_height):
+    return db_session.query(BalanceCheckpoint).filter(
+        BalanceCheckpoint.contract_id == contract_id,
+        BalanceCheckpoint.block_number <= block_height
+    ).order_by(BalanceCheckpoint.block_number.desc()).first()
+
+
+def stream_events(db_session, contract_id, after_block, upto_block, columns, batch_size=STREAM_BATCH_SIZE):
+    """Yield plain row tuples for events in (after_block, upto_block], in order.
+
+    Rows are fetched batch_size at a time from a streaming cursor, so memory
+    stays flat however many events the range holds.
+    """
+    query = select(*columns).where(
+        Event.contract_id == contract_id,
+        Event.block_number > after_block,
+        Event.block_number <= upto_block
+    ).order_by(Event.block_number, Event.log_index).execution_options(yield_per=batch_size)
+
+    for partition in db_session.execute(query).partitions():
+        yield from partition
+
+
+def replay_balances(db_session, contract_id, block_height):
+    # Balances keyed by address id after every event up to block_height,
+    # starting from the nearest checkpoint instead of the first event
+    checkpoint = nearest_checkpoint(db_session, contract_id, block_height)
+    if checkpoint is None:
+        balances = defaultdict(int)
+        after_block = -1
+    else:
+        balances = unpack_balances(checkpoint.balances)
+        after_block = checkpoint.block_number
+
+    events = stream_events(db_session, contract_id, after_block, block_height, (Event.from_id, Event.to_id, Event.value))
+
+    for from_id, to_id, value in events:
+        value = decode_value(value)
+        balances[from_id] -= value
+        balances[to_id] += value
+
+    return balances
+
+
+def write_checkpoint(db_session, contract_id, block_number):
+    balances = replay_balances(db_session, contract_id, block_number)
+    db_session.merge(BalanceCheckpoint(
+        contract_id=contract_id,
+        block_number=block_number,
+        balances=pack_balances(balances)
+    ))
+
+
+def invalidate_checkpoints(db_session, contract_id, from_block):
+    # Checkpoints at or above a re-indexed block no longer match the events
+    db_session.query(BalanceCheckpoint).filter(
+        BalanceCheckpoint.contract_id == contract_id,
+        BalanceCheckpoint.block_number >= from_block
+    ).delete(synchronize_session=False)
+
+
+def count_events(db_session, contract_id, after_block, upto_block):
+    return db_session.query(func.count()).select_from(Event).filter(
+        Event.contract_id == contract_id,
+        Event.block_number > after_block,
+        Event.block_number <= upto_block
+    ).scalar()
+
+
+def checkpoint_progress(db_session, contract_id, block_number):
+    # The latest checkpoint at or below block_number and the events stored after it
+    latest = nearest_checkpoint(db_session, contract_id, block_number)
+    last_block = latest.block_number if latest else -1
+    return last_block, count_events(db_session, contract_id, last_block, block_number)
+
+
+def maybe_checkpoint(db_session, contract_id, end_block, every_blocks, every_events, last_block, stored):
+    """Write a checkpoint once events up to end_block are stored.
+
+    Checkpoints land on multiples of every_blocks, or at end_block when
+    every_events events have been stored since the previous one. Either
+    rule is off when set to 0. last_block and stored come from
+    checkpoint_progress(), kept up to date by the caller with the
+    (last_block, stored) returned here.
+    """
+    if every_blocks:
+        boundary = end_block // every_blocks * every_blocks
+        if boundary > 0 and boundary > last_block:
+            write_checkpoint(db_session, contract_id, boundary)
+            return boundary, count_events(db_session, contract_id, boundary, end_block)
+
+    if every_events and stored >= every_events:
+        write_checkpoint(db_session, contract_id, end_block)
+        return end_block, 0
+    return last_block, stored
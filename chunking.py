@@ -0,0 +1,64 @@
+import asyncio
+
+# Fragments of the errors providers return when an eth_getLogs window holds
+# too many logs or takes too long to serve.
+RANGE_ERROR_MARKERS = (
+    'more than',
+    'too many',
+    'limit exceeded',
+    'response size',
+    'block range',
+    'range too large',
+    'http 413',
+    'timeout',
+    'timed out',
+    '-32005',
+)
+
+
+def is_range_error(exc):
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    if 'Timeout' in type(exc).__name__:
+        return True
+    message = str(exc).lower()
+    return any(marker in message for marker in RANGE_ERROR_MARKERS)
+
+
+class AdaptiveChunkSize:
+    """Block window size that follows what the provider accepts.
+
+    A rejected window halves the size and caps future growth below the span
+    that failed. Full windows that come back with few logs and quickly grow
+    the size again, and the cap is lifted after a long run of successes.
+    """
+
+    def __init__(self, size, min_size=1, max_size=None, target_logs=5000,
+                 target_seconds=2.0, growth=1.5, relax_after=50):
+        self.min_size = max(1, min_size)
+        self.max_size = max_size or size
+        self.size = max(self.min_size, min(size, self.max_size))
+        self.target_logs = target_logs
+        self.target_seconds = target_seconds
+        self.growth = growth
+        self.relax_after = relax_after
+        self.ceiling = self.max_size
+        self.successes = 0
+
+    def shrink(self, span):
+        self.ceiling = max(self.min_size, min(self.ceiling, span - 1))
+        self.size = max(self.min_size, min(self.size, span // 2))
+        self.successes = 0
+
+    def record(self, span, log_count, elapsed):
+        self.successes += 1
+        if self.successes >= self.relax_after:
+            self.ceiling = self.max_size
+            self.successes = 0
+
+        # Windows cut short by a split or by the chain head say nothing about
+        # whether a bigger window would be accepted.
+        if span < self.size:
+            return
+        if log_count * 2 < self.target_logs and elapsed * 2 < self.target_seconds:
+            self.size = min(self.ceiling, max(self.size + 1, int(self.size * self.growth)))
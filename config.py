@@ -1,22 +1,47 @@
+import os
 import yaml
 
+# CONFIG_FILE selects another config file, benchmarks/run.py uses a scratch one
+CONFIG_PATH = os.environ.get('CONFIG_FILE', 'config.yml')
+
+class Config(dict):
+    """config.yml as the plain mapping it always was, plus lookup indexes.
+
+    chains maps chain ids to their entries, contracts maps (chain id,
+    lowercased address) to contract entries and exclusions holds the
+    excluded addresses of each contract as a set of lowercased addresses.
+    """
+
+    def __init__(self, data):
+        super().__init__(data or {})
+        self.chains = {chain['id']: chain for chain in self.get('chains', [])}
+        self.contracts = {
+            (chain['id'], contract['address'].lower()): contract
+            for chain in self.get('chains', [])
+            for contract in chain.get('contracts', [])
+        }
+        self.exclusions = {
+            key: frozenset(address.lower() for address in contract.get('excluded_addresses', []))
+            for key, contract in self.contracts.items()
+        }
+
+config = None
+
 def load_config():
-    with open("config.yml", 'r') as ymlfile:
-        return yaml.safe_load(ymlfile)
+    # Parsed on first use and shared by every caller in the process
+    global config
+    if config is None:
+        with open(CONFIG_PATH, 'r') as ymlfile:
+            config = Config(yaml.safe_load(ymlfile))
+    return config
 
 def get_excluded_address(chain_id, contract_address):
-    cfg = load_config()
-    for chain in cfg['chains']:
-        if chain['id'] == chain_id:
-            for contract in chain['contracts']:
-                if contract['address'] == contract_address:
-                    return contract['excluded_addresses']
-            break
-    return []
+    # Lowercased, compare with address.lower()
+    return load_config().exclusions.get((chain_id, contract_address.lower()), frozenset())
+
+def get_chain(chain_id):
+    return load_config().chains.get(chain_id)
 
 def get_rpc(chain_id):
-    cfg = load_config()
-    for chain in cfg['chains']:
-        if chain['id'] == chain_id:
-            return chain['rpc_url']
-    return None
\ No newline at end of file
+    chain = get_chain(chain_id)
+    return chain['rpc_url'] if chain else None
@@ -1,5 +1,12 @@
-from sqlalchemy import create_engine, Column, String, Integer, ForeignKey
+import os
+from sqlalchemy import create_engine, event, inspect, select, Column, String, Integer, LargeBinary, Text, Float, ForeignKey, Index
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+# Shared with the snapshot files, importing them does not need SQLAlchemy
+from snapfile import checksum_address, hex_to_bytes
+
+# EVENTS_DB selects another SQLite file for every tool sharing this module
+DB_PATH = os.environ.get('EVENTS_DB', 'events.db')
 
 Base = declarative_base()
 
@@ -22,20 +29,154 @@ class Contract(Base):
     chain = relationship('Chain', back_populates='contracts')
     events = relationship('Event', back_populates='contract')
 
+class Address(Base):
+    __tablename__ = 'addresses'
+
+    id = Column(Integer, primary_key=True)
+    address = Column(LargeBinary(20), unique=True, nullable=False)
+
 class Event(Base):
     __tablename__ = 'events'
+    # The primary key doubles as the snapshot index: rows are clustered by
+    # contract and block, and a log can only be stored once.
+    __table_args__ = {'sqlite_with_rowid': False}
 
-    id = Column(Integer, primary_key=True)
-    contract_id = Column(Integer, ForeignKey('contracts.id'), nullable=False)
-    from_address = Column(String)
-    to_address = Column(String)
-    value = Column(String)
-    block_number = Column(Integer)
-    transaction_hash = Column(String)
+    contract_id = Column(Integer, ForeignKey('contracts.id'), primary_key=True)
+    block_number = Column(Integer, primary_key=True)
+    log_index = Column(Integer, primary_key=True)
+    from_id = Column(Integer, ForeignKey('addresses.id'), nullable=False)
+    to_id = Column(Integer, ForeignKey('addresses.id'), nullable=False)
+    value = Column(LargeBinary(32), nullable=False)
+    transaction_hash = Column(LargeBinary(32), nullable=False)
 
     contract = relationship('Contract', back_populates='events')
 
-def init_db():
-    engine = create_engine('sqlite:///events.db')
+class BalanceCheckpoint(Base):
+    __tablename__ = 'balance_checkpoints'
+
+    # Every holder balance after all events up to and including block_number,
+    # packed by checkpoints.pack_balances
+    contract_id = Column(Integer, ForeignKey('contracts.id'), primary_key=True)
+    block_number = Column(Integer, primary_key=True)
+    balances = Column(LargeBinary, nullable=False)
+
+class BlockHash(Base):
+    __tablename__ = 'block_hashes'
+
+    # Hashes of recently indexed blocks, used to spot reorgs
+    chain_id = Column(Integer, ForeignKey('chains.id'), primary_key=True)
+    block_number = Column(Integer, primary_key=True)
+    hash = Column(LargeBinary(32), nullable=False)
+
+class ChunkSize(Base):
+    __tablename__ = 'chunk_sizes'
+
+    # contract_id 0 holds the size learned by a chain-wide scan, -n the one
+    # of worker n when the chain is split across processes
+    chain_id = Column(Integer, ForeignKey('chains.id'), primary_key=True)
+    contract_id = Column(Integer, primary_key=True)
+    size = Column(Integer, nullable=False)
+
+class AirdropChunk(Base):
+    __tablename__ = 'airdrop_chunks'
+    # One row per airdrop transaction. Status goes from queued to pending
+    # once sent, then to success or failed. A failed chunk becomes retried
+    # when a later run sends its recipients again.
+    __table_args__ = (Index('ix_airdrop_chunks_status', 'chain_id', 'contract_address', 'status'),)
+
+    id = Column(String, primary_key=True)
+    chain_id = Column(Integer, nullable=False)
+    contract_address = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    addresses = Column(Text, nullable=False)
+    # JSON list, token amounts do not fit in an SQLite integer
+    balances = Column(Text, nullable=False)
+    # JSON list of every transaction sent for the chunk, replacements included
+    transaction_hash = Column(String)
+    retry = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Float, nullable=False)
+
+def sqlite_pragmas(write_heavy):
+    # WAL lets snapshots read while the indexer writes, and NORMAL sync is
+    # still crash safe in WAL mode. Write-heavy runs also get a bigger page
+    # cache (negative values are KiB) and in-memory temp storage.
+    pragmas = ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=NORMAL']
+    if write_heavy:
+        pragmas += ['PRAGMA cache_size=-262144', 'PRAGMA temp_store=MEMORY']
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return on_connect
+
+def encode_value(value):
+    return int(value).to_bytes(32, 'big')
+
+def decode_value(value):
+    return int.from_bytes(value, 'big')
+
+class AddressBook:
+    """Maps checksummed addresses to their ids in the addresses table.
+
+    Ids of new addresses come from the caller's transaction, so clear() the
+    book whenever that transaction is rolled back.
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def clear(self):
+        self.ids.clear()
+
+    def resolve(self, db_session, addresses):
+        missing = {address for address in addresses if address not in self.ids}
+        if missing:
+            by_bytes = {hex_to_bytes(address): address for address in missing}
+            connection = db_session.connection()
+            connection.execute(
+                sqlite_insert(Address.__table__).on_conflict_do_nothing(),
+                [{'address': raw} for raw in by_bytes]
+            )
+            raw_addresses = list(by_bytes)
+            for i in range(0, len(raw_addresses), 500):
+                rows = connection.execute(
+                    select(Address.id, Address.address).where(Address.address.in_(raw_addresses[i:i + 500]))
+                )
+                for address_id, raw in rows:
+                    self.ids[by_bytes[raw]] = address_id
+        return self.ids
+
+def load_addresses(db_session, address_ids):
+    # id -> checksummed address, for turning id-keyed balances back into output
+    address_ids = list(address_ids)
+    addresses = {}
+    for i in range(0, len(address_ids), 500):
+        rows = db_session.execute(
+            select(Address.id, Address.address).where(Address.id.in_(address_ids[i:i + 500]))
+        )
+        for address_id, raw in rows:
+            addresses[address_id] = checksum_address(raw)
+    return addresses
+
+def bulk_insert_events(db_session, rows):
+    # One executemany through Core on the session's transaction, skipping the
+    # ORM unit of work entirely. Logs already stored are left alone and not
+    # counted, the return value is the number of rows actually inserted.
+    if not rows:
+        return 0
+    return db_session.connection().execute(sqlite_insert(Event.__table__).on_conflict_do_nothing(), rows).rowcount
+
+def check_schema(engine):
+    columns = {column['name'] for column in inspect(engine).get_columns('events')}
+    if 'from_address' in columns:
+        raise Exception('events.db uses the old events layout, run `python migrate.py` to upgrade it')
+
+def init_db(write_heavy=False):
+    engine = create_engine(f'sqlite:///{DB_PATH}')
+    event.listen(engine, 'connect', sqlite_pragmas(write_heavy))
     Base.metadata.create_all(engine)
+    check_schema(engine)
     return sessionmaker(bind=engine)
\ No newline at end of file
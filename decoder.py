@@ -0,0 +1,62 @@
+from functools import lru_cache
+from hexbytes import HexBytes
+from web3 import Web3
+
+TRANSFER_TOPIC = bytes(Web3.keccak(text="Transfer(address,address,uint256)"))
+TRANSFER_TOPIC_HEX = '0x' + TRANSFER_TOPIC.hex()
+
+ADDRESS_PADDING = bytes(12)
+
+
+def as_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return bytes(HexBytes(value))
+
+
+@lru_cache(maxsize=65536)
+def topic_to_address(topic):
+    # Checksumming hashes the address, and busy tokens see the same holders
+    # over and over, so remember the result
+    return Web3.to_checksum_address('0x' + topic[12:].hex())
+
+
+def decode_transfer(log):
+    """Decode an ERC20 Transfer log without going through the ABI machinery.
+
+    Returns None when the log is not shaped like Transfer(address,address,uint256)
+    with both addresses indexed, so the caller can fall back to web3.
+    """
+    topics = log['topics']
+    if len(topics) != 3:
+        return None
+
+    signature, sender, receiver = (as_bytes(topic) for topic in topics)
+    data = as_bytes(log['data'])
+    if (signature != TRANSFER_TOPIC or len(data) != 32
+            or sender[:12] != ADDRESS_PADDING or receiver[:12] != ADDRESS_PADDING):
+        return None
+
+    return {
+        'args': {
+            'from': topic_to_address(sender),
+            'to': topic_to_address(receiver),
+            'value': int.from_bytes(data, 'big'),
+        },
+        'event': 'Transfer',
+        'address': log['address'],
+        'blockNumber': log['blockNumber'],
+        'transactionHash': log['transactionHash'],
+        'logIndex': log['logIndex'],
+    }
+
+
+def decode_transfers(logs, contract):
+    # Logs that do not match the fast path go through the contract's ABI
+    entries = []
+    for log in logs:
+        entry = decode_transfer(log)
+        if entry is None:
+            entry = contract.events.Transfer().process_log(log)
+        entries.append(entry)
+    return entries
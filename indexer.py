@@ -1,60 +1,160 @@
+import argparse
 import asyncio
 import json
-from web3 import Web3, HTTPProvider
-from web3.middleware import geth_poa_middleware
-from concurrent.futures import ThreadPoolExecutor
-from database import init_db, Chain, Contract, Event
+import multiprocessing
+import random
+import time
+from collections import deque
+from functools import lru_cache
+from database import init_db, Chain, Contract, ChunkSize
+from chunking import AdaptiveChunkSize, is_range_error
+from decoder import TRANSFER_TOPIC_HEX, decode_transfers
+from chainhead import HeadTracker
+from reorg import ReorgDetected, ReorgGuard
+from writer import IndexWriter, LocalWriter, RemoteWriter, serve
 from config import load_config
+from hexbytes import HexBytes
+from logcache import LogCache
+from logs import log
+from metrics import (
+    instrumented, INDEXER_CACHE_HITS, INDEXER_COMMIT_SECONDS, INDEXER_DECODE_SECONDS, INDEXER_HEAD, INDEXER_LAG,
+    INDEXER_LOGS, INDEXER_LOGS_RATE, INDEXER_ROWS, INDEXER_ROWS_RATE
+)
+from rpc import DEFAULT_BATCH_SIZE, AsyncRpcClient, CallBatcher, encode_filter, format_log, get_pool, make_web3
 
-cfg = load_config()
+# The database and the ABI are loaded on first use, importing the indexer
+# (as airdrop.py does) costs nothing until it runs
+Session = None
 
-w3executor = ThreadPoolExecutor(max_workers=10)
 
-Session = init_db()
+def new_session():
+    global Session
+    if Session is None:
+        Session = init_db(write_heavy=True)
+    return Session()
 
-try:
-    with open('erc20.abi.json') as f:
-        abi = json.load(f)
-except FileNotFoundError:
-    raise Exception('ABI file not found: erc20.abi.json')
 
-async def get_event_data(contract, start_block, end_block, web3):
+@lru_cache(maxsize=None)
+def erc20_abi():
     try:
-        print(f"Getting events for {contract['contract'].address} from {start_block} to {end_block}")
-        loop = asyncio.get_event_loop()
+        with open('erc20.abi.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise Exception('ABI file not found: erc20.abi.json')
+
+async def get_logs(rpc, filter_params, batcher=None, cache=None):
+    """Transfer logs of the filter, from the log cache when it holds the whole range.
+
+    cache is a LogCache, or None to always ask the node. Fetched ranges are
+    staged in the cache until their window is committed. An offline cache
+    never falls back to the node.
+    """
+    addresses = filter_params['address']
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    start_block, end_block = filter_params['fromBlock'], filter_params['toBlock']
+
+    logs = cache.read(addresses, start_block, end_block) if cache is not None else None
+    if logs is not None:
+        INDEXER_CACHE_HITS.inc(chain=rpc.pool.chain)
+    elif cache is not None and cache.offline:
+        raise Exception(f"Blocks {start_block} to {end_block} are not in the log cache")
+    else:
+        params = [encode_filter(filter_params)]
+        if batcher is not None:
+            logs = await batcher.call('eth_getLogs', params)
+        else:
+            logs = await rpc.call('eth_getLogs', params)
+        if cache is not None:
+            cache.stage(addresses, start_block, end_block, logs)
+    INDEXER_LOGS.inc(len(logs), chain=rpc.pool.chain)
+    INDEXER_LOGS_RATE.mark(len(logs), chain=rpc.pool.chain)
+    return [format_log(entry) for entry in logs]
+
+
+def fetch_error_level(exc, start_block, end_block):
+    # A rejected window that fetch_adaptive is about to split is routine
+    return 'warning' if end_block > start_block and is_range_error(exc) else 'error'
 
-        transfer_signature = Web3.keccak(text="Transfer(address,address,uint256)").hex()
+
+async def get_event_data(contract, start_block, end_block, rpc, batcher=None, cache=None):
+    try:
+        log(
+            f"Getting events for {contract['contract'].address} from {start_block} to {end_block}",
+            contract=contract['contract'].address, start_block=start_block, end_block=end_block
+        )
 
         # Define the filter parameters
         filter_params = {
             "fromBlock": start_block,
             "toBlock": end_block,
             "address": contract['contract'].address,
-            "topics": [transfer_signature]
+            "topics": [TRANSFER_TOPIC_HEX]
         }
 
         # Get the logs using eth_getLogs
-        logs = await loop.run_in_executor(w3executor, lambda: web3.eth.get_logs(filter_params))
+        logs = await get_logs(rpc, filter_params, batcher, cache)
 
         # Parse the logs
-        entries = [contract['contract'].events.Transfer().process_log(log) for log in logs]
+        with INDEXER_DECODE_SECONDS.time(chain=rpc.pool.chain):
+            entries = decode_transfers(logs, contract['contract'])
 
         return entries
 
     except Exception as exc:
-        print(f"Error getting events for {contract['contract'].address} from {start_block} to {end_block}: {exc}")
+        log(
+            f"Error getting events for {contract['contract'].address} from {start_block} to {end_block}: {exc}",
+            level=fetch_error_level(exc, start_block, end_block), contract=contract['contract'].address, start_block=start_block, end_block=end_block
+        )
         raise
 
 
-def setup_web3(chain_cfg):
-    # Set up web3 instance
-    w3 = Web3(HTTPProvider(chain_cfg['rpc_url']))
+async def get_chain_event_data(contracts, start_block, end_block, rpc, batcher=None, cache=None):
+    # One eth_getLogs for every contract in the group, split back out by emitter
+    addresses = [contract['contract'].address for contract in contracts]
+    try:
+        log(
+            f"Getting events for {len(addresses)} contracts from {start_block} to {end_block}",
+            contracts=len(addresses), start_block=start_block, end_block=end_block
+        )
+
+        filter_params = {
+            "fromBlock": start_block,
+            "toBlock": end_block,
+            "address": addresses,
+            "topics": [TRANSFER_TOPIC_HEX]
+        }
+
+        logs = await get_logs(rpc, filter_params, batcher, cache)
+
+        by_address = {contract['contract'].address: contract for contract in contracts}
+        grouped = {address: [] for address in addresses}
+        for entry in logs:
+            if entry['address'] in grouped:
+                grouped[entry['address']].append(entry)
 
-    # This line is necessary for some networks (like Rinkeby)
-    w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+        with INDEXER_DECODE_SECONDS.time(chain=rpc.pool.chain):
+            entries = {
+                address: decode_transfers(grouped[address], by_address[address]['contract'])
+                for address in addresses
+            }
+
+        return entries
+
+    except Exception as exc:
+        log(
+            f"Error getting events for {len(addresses)} contracts from {start_block} to {end_block}: {exc}",
+            level=fetch_error_level(exc, start_block, end_block), contracts=len(addresses), start_block=start_block, end_block=end_block
+        )
+        raise
+
+
+def setup_web3(chain_cfg):
+    # Set up web3 instance on the chain's pool of RPC endpoints
+    w3 = make_web3(chain_cfg)
 
     # Create and commit Chain object
-    db_session = Session()
+    db_session = new_session()
     chain = db_session.query(Chain).filter_by(id=chain_cfg['id']).first()
     if chain is None:
         chain = Chain(id=chain_cfg['id'], name=chain_cfg['name'])
@@ -65,12 +165,12 @@ def setup_web3(chain_cfg):
     for contract_cfg in chain_cfg['contracts']:
         # Set up the contract
         contract_address = w3.to_checksum_address(contract_cfg['address'])
-        contract_obj = w3.eth.contract(address=contract_address, abi=abi)
+        contract_obj = w3.eth.contract(address=contract_address, abi=erc20_abi())
 
         # Query existing contract from the database
         db_contract = db_session.query(Contract).filter_by(address=contract_address).first()
         if db_contract is None:
-            print(f"Adding new contract {contract_address}")
+            log(f"Adding new contract {contract_address}", chain=chain_cfg['id'], contract=contract_address)
             last_processed_block = contract_cfg.get('startblock', 0) - 1
             name = contract_cfg.get('name', None)
             contract_db = Contract(
@@ -82,63 +182,512 @@ def setup_web3(chain_cfg):
             db_session.add(contract_db)
             db_session.commit()
         else:
-            print(f"Found existing contract {contract_address}")
+            log(f"Found existing contract {contract_address}", chain=chain_cfg['id'], contract=contract_address)
             contract_db = db_contract
 
+        # Detached, the indexer only keeps its cursor in memory and the
+        # writer owns every change to the row
+        db_session.refresh(contract_db)
+        db_session.expunge(contract_db)
         contract_dict = {'contract': contract_obj, 'db_contract': contract_db}
         contracts.append(contract_dict)
 
-    return w3, contracts, db_session
+    db_session.close()
+    return w3, contracts
 
 
 def get_last_processed_block(chain, contract):
-    db_session = Session()
-    db_contract = db_session.query(Contract).filter_by(address=contract).first()
-    if db_contract is None:
-        return 0
-    else:
-        return db_contract.last_processed_block
-    db.session.close()
+    # A plain read for other tools, without the indexer's write-heavy settings
+    with init_db()() as db_session:
+        db_contract = db_session.query(Contract).filter_by(address=contract).first()
+        if db_contract is None:
+            return 0
+        else:
+            return db_contract.last_processed_block
+
+
+async def get_block_number(rpc):
+    return int(await rpc.call('eth_blockNumber', []), 16)
+
 
+async def get_block_hash(rpc, block_number):
+    block = await rpc.call('eth_getBlockByNumber', [hex(block_number), False])
+    if block is None:
+        raise Exception(f"Block {block_number} not found")
+    return bytes(HexBytes(block['hash']))
 
-async def process_chain(chain):
-    web3, contracts, db_session = setup_web3(chain)
-    chunk_size = chain['chunk_size']
 
+def merge_results(left, right):
+    if isinstance(left, dict):
+        return {key: left[key] + right[key] for key in left}
+    return left + right
+
+
+def count_results(result):
+    if isinstance(result, dict):
+        return sum(len(entries) for entries in result.values())
+    return len(result)
+
+
+async def fetch_adaptive(fetch, start_block, end_block, chunker):
+    started = time.monotonic()
+    try:
+        result = await fetch(start_block, end_block)
+    except Exception as exc:
+        if end_block <= start_block or not is_range_error(exc):
+            raise
+        # The provider rejected the window, split it in half and try again
+        chunker.shrink(end_block - start_block + 1)
+        middle = (start_block + end_block) // 2
+        left = await fetch_adaptive(fetch, start_block, middle, chunker)
+        right = await fetch_adaptive(fetch, middle + 1, end_block, chunker)
+        return merge_results(left, right)
+
+    chunker.record(end_block - start_block + 1, count_results(result), time.monotonic() - started)
+    return result
+
+
+def get_chunker(chain_cfg, contract_id):
+    if not chain_cfg.get('adaptive_chunk_size', True):
+        # Fixed size, still split on rejected windows but never grow past it
+        return AdaptiveChunkSize(chain_cfg['chunk_size'])
+
+    # Start from the size learned on a previous run, if any
+    with new_session() as db_session:
+        size = db_session.query(ChunkSize.size).filter_by(chain_id=chain_cfg['id'], contract_id=contract_id).scalar()
+
+    chunker = AdaptiveChunkSize(
+        size or chain_cfg['chunk_size'],
+        min_size=chain_cfg.get('min_chunk_size', 1),
+        max_size=chain_cfg.get('max_chunk_size', chain_cfg['chunk_size'] * 10),
+        target_logs=chain_cfg.get('target_logs_per_window', 5000),
+        target_seconds=chain_cfg.get('target_seconds_per_window', 2.0),
+    )
+    return chunker
+
+
+async def run_windows(start_block, end_block, chunker, max_in_flight, fetch, store):
+    # Keep up to max_in_flight windows fetching at once, but hand results to
+    # store strictly in block order so the committed range is always contiguous.
+    pending = deque()
+    next_start = start_block
+    try:
+        while pending or next_start <= end_block:
+            while next_start <= end_block and len(pending) < max_in_flight:
+                window_end = min(next_start + chunker.size - 1, end_block)
+                task = asyncio.ensure_future(fetch_adaptive(fetch, next_start, window_end, chunker))
+                pending.append((next_start, window_end, task))
+                next_start = window_end + 1
+
+            window_start, window_end, task = pending.popleft()
+            await store(window_start, window_end, await task)
+    finally:
+        for _, _, task in pending:
+            task.cancel()
+
+
+def event_rows(events):
+    # Compact, picklable form of decoded events for the writer
+    return [
+        (
+            event['blockNumber'],
+            event['logIndex'],
+            event['args']['from'],
+            event['args']['to'],
+            event['args']['value'],
+            bytes(event['transactionHash']),
+        )
+        for event in events
+    ]
+
+
+async def store_window(state, contracts, window_start, window_end, entries, block_hashes, chunk_key, chunk_size):
+    # Hand a fetched window to the writer, then move the in-memory cursors
+    batches = [
+        (contract['db_contract'].id, event_rows(entries[contract['contract'].address]))
+        for contract in contracts
+    ]
+    cache_records = state['cache'].take([contract['contract'].address for contract in contracts], window_end) \
+        if state['cache'] is not None else []
+    chain_id = state['cfg']['id']
+    started = time.perf_counter()
+    rows = await state['writer'].call(
+        'store_window',
+        state['cfg']['id'],
+        window_start,
+        window_end,
+        batches,
+        block_hashes,
+        chunk_key,
+        chunk_size,
+        (state['cfg'].get('checkpoint_blocks', 100000), state['cfg'].get('checkpoint_events', 50000)),
+        cache_records,
+    )
+    INDEXER_COMMIT_SECONDS.observe(time.perf_counter() - started, chain=chain_id)
+    INDEXER_ROWS.inc(rows, chain=chain_id)
+    INDEXER_ROWS_RATE.mark(rows, chain=chain_id)
     for contract in contracts:
-        start_block = contract['db_contract'].last_processed_block + 1
-
-        while start_block <= web3.eth.block_number:
-            end_block = min(start_block + chunk_size - 1, web3.eth.block_number)
-            events = await get_event_data(contract, start_block, end_block, web3)
-
-            # Insert events into the database
-            for event in events:
-                db_event = Event(
-                    contract_id=contract['db_contract'].id,
-                    from_address=event['args']['from'],
-                    to_address=event['args']['to'],
-                    value=str(event['args']['value']),
-                    block_number=event['blockNumber'],
-                    transaction_hash=event['transactionHash'].hex(),
+        contract['db_contract'].last_processed_block = window_end
+    report_lag(state, contracts)
+    return rows
+
+
+def report_lag(state, contracts):
+    head = state['tracker'].head
+    if head is None:
+        return
+    for contract in contracts:
+        INDEXER_LAG.set(
+            head - contract['db_contract'].last_processed_block,
+            chain=state['cfg']['id'],
+            contract=contract['contract'].address
+        )
+
+
+def reload_cursors(contracts, cache=None):
+    # After a rollback the in-memory cursors can be ahead of the database,
+    # and logs staged for windows past them are fetched again
+    if cache is not None:
+        cache.unstage([contract['contract'].address for contract in contracts])
+    with new_session() as db_session:
+        cursors = dict(db_session.query(Contract.id, Contract.last_processed_block).filter(
+            Contract.id.in_([contract['db_contract'].id for contract in contracts])
+        ).all())
+    for contract in contracts:
+        contract['db_contract'].last_processed_block = cursors[contract['db_contract'].id]
+
+
+class IngestStats:
+    def __init__(self, label):
+        self.label = label
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, rows, seconds):
+        self.rows += rows
+        self.seconds += seconds
+
+    def report(self):
+        if self.rows:
+            rate = self.rows / self.seconds if self.seconds else float('inf')
+            log(
+                f"Stored {self.rows} events for {self.label} in {self.seconds:.2f}s ({rate:.0f} rows/s)",
+                target=self.label, rows=self.rows, seconds=round(self.seconds, 3)
+            )
+        self.rows = 0
+        self.seconds = 0.0
+
+
+def make_fetch(state, get_data):
+    # Fetch a window, first recording the hash of its last block when that
+    # block is recent enough to be reorged. Reading the hash before the logs
+    # means a reorg in between always shows up as a mismatch later.
+    hashes = {}
+
+    async def fetch(start_block, end_block):
+        block_hash = None
+        if state['guard'].tracks(end_block, state['tracker'].head):
+            block_hash = await get_block_hash(state['rpc'], end_block)
+        result = await get_data(start_block, end_block)
+        if block_hash is not None:
+            hashes[end_block] = block_hash
+        return result
+
+    def take_hashes(end_block):
+        return [(block, hashes.pop(block)) for block in sorted(hashes) if block <= end_block]
+
+    return fetch, take_hashes
+
+
+async def safe_head(state):
+    # Latest block that has the configured number of confirmations on top
+    head = await state['tracker'].latest() - state['cfg'].get('confirmations', 0)
+    if await state['guard'].check(head) is not None:
+        reload_cursors(state['contracts'], state['cache'])
+    INDEXER_HEAD.set(head, chain=state['cfg']['id'])
+    report_lag(state, state['contracts'])
+    return head
+
+
+async def wait_for_blocks(state, last_block):
+    await state['tracker'].wait_beyond(last_block + state['cfg'].get('confirmations', 0))
+
+
+async def back_off(state, contracts, exc, delay):
+    # In follow mode an error that outlived the RPC retries does not end the
+    # chain: wait, then resume from the committed cursors. Returns the next delay.
+    delay = min(60.0, max(delay * 2, state['cfg'].get('poll_interval', 2.0))) * random.uniform(0.8, 1.2)
+    log(
+        f"Error indexing chain {state['cfg']['id']}, resuming in {delay:.1f}s: {exc}",
+        level='error', chain=state['cfg']['id'], retry_in=round(delay, 1)
+    )
+    await asyncio.sleep(delay)
+    reload_cursors(contracts, state['cache'])
+    return delay
+
+
+async def process_contract(contract, state):
+    chunker = get_chunker(state['cfg'], contract['db_contract'].id)
+    stats = IngestStats(contract['contract'].address)
+    delay = 0.0
+
+    async def get_data(start_block, end_block):
+        return await get_event_data(contract, start_block, end_block, state['rpc'], state['batcher'], state['cache'])
+
+    while True:
+        try:
+            head = await safe_head(state)
+            start_block = contract['db_contract'].last_processed_block + 1
+            if start_block > head:
+                stats.report()
+                if not state['follow']:
+                    break
+                await wait_for_blocks(state, start_block - 1)
+                continue
+
+            fetch, take_hashes = make_fetch(state, get_data)
+
+            async def store(window_start, window_end, events):
+                started = time.monotonic()
+                rows = await store_window(
+                    state,
+                    [contract],
+                    window_start,
+                    window_end,
+                    {contract['contract'].address: events},
+                    take_hashes(window_end),
+                    contract['db_contract'].id,
+                    chunker.size,
                 )
-                db_session.add(db_event)
+                stats.add(rows, time.monotonic() - started)
+
+            # Only contracts that are catching up hold one of the chain's slots
+            async with state['contract_slots']:
+                await run_windows(start_block, head, chunker, state['max_windows'], fetch, store)
+            delay = 0.0
+        except ReorgDetected as exc:
+            log(f"Restarting after reorg: {exc}", level='warning', chain=state['cfg']['id'])
+            reload_cursors([contract], state['cache'])
+        except Exception as exc:
+            if not state['follow']:
+                raise
+            delay = await back_off(state, [contract], exc, delay)
+
+
+async def process_contract_group(state):
+    # Contracts sharing a cursor are scanned together. The group at the lowest
+    # cursor is caught up to the next one, where it merges with the contracts
+    # already there, until everything moves as a single shared scan.
+    contracts = state['contracts']
+    # Workers of a chain split across processes each learn their own size
+    chunk_key = -state['cfg'].get('worker', 0)
+    chunker = get_chunker(state['cfg'], chunk_key)
+    stats = IngestStats(f"chain {state['cfg']['id']}")
+    delay = 0.0
+
+    while True:
+        try:
+            head = await safe_head(state)
+            cursors = sorted({contract['db_contract'].last_processed_block for contract in contracts})
+            start_block = cursors[0] + 1
+            if start_block > head:
+                stats.report()
+                if not state['follow']:
+                    break
+                await wait_for_blocks(state, cursors[0])
+                continue
+            end_block = min(cursors[1], head) if len(cursors) > 1 else head
+            group = [contract for contract in contracts if contract['db_contract'].last_processed_block == cursors[0]]
+
+            async def get_data(window_start, window_end):
+                return await get_chain_event_data(group, window_start, window_end, state['rpc'], state['batcher'], state['cache'])
+
+            fetch, take_hashes = make_fetch(state, get_data)
+
+            async def store(window_start, window_end, entries):
+                started = time.monotonic()
+                rows = await store_window(state, group, window_start, window_end, entries, take_hashes(window_end), chunk_key, chunker.size)
+                stats.add(rows, time.monotonic() - started)
+
+            await run_windows(start_block, end_block, chunker, state['max_windows'], fetch, store)
+            delay = 0.0
+        except ReorgDetected as exc:
+            log(f"Restarting after reorg: {exc}", level='warning', chain=state['cfg']['id'])
+            reload_cursors(contracts, state['cache'])
+        except Exception as exc:
+            if not state['follow']:
+                raise
+            delay = await back_off(state, contracts, exc, delay)
+
+
+def get_log_cache(chain_cfg, offline=False):
+    directory = load_config().get('log_cache_dir')
+    if offline and not directory:
+        raise Exception('Reindexing from the log cache needs log_cache_dir in config.yml')
+    return LogCache(directory, chain_cfg['id'], offline) if directory else None
+
+
+def cached_head(cache, contracts):
+    """Last block every cached contract can be indexed to without the node.
+
+    Contracts with nothing cached past their cursor are dropped, the others
+    stop where the shortest cached run ends.
+    """
+    cached = []
+    for contract in contracts:
+        cursor = contract['db_contract'].last_processed_block
+        covered = cache.covered_until(contract['contract'].address, cursor + 1)
+        if covered > cursor:
+            cached.append((contract, covered))
+        else:
+            log(
+                f"No cached logs for {contract['contract'].address} after block {cursor}, skipping it",
+                level='warning', contract=contract['contract'].address, block=cursor
+            )
+    return [contract for contract, _ in cached], min((covered for _, covered in cached), default=None)
+
+
+async def process_chain(chain, writer, follow=False, offline=False):
+    web3, contracts = setup_web3(chain)
+
+    rpc = AsyncRpcClient(get_pool(chain), chain.get('rpc_concurrency', 16), chain.get('rpc_batch_size', DEFAULT_BATCH_SIZE))
+
+    # eth_getLogs windows in flight at the same time share one HTTP request
+    batcher = CallBatcher(rpc) if rpc.batch_size > 1 else None
+
+    cache = get_log_cache(chain, offline)
+
+    state = {
+        'cfg': chain,
+        'rpc': rpc,
+        'batcher': batcher,
+        'cache': cache,
+        'writer': writer,
+        'contracts': contracts,
+        'follow': follow,
+        'max_windows': chain.get('max_concurrent_windows', 4),
+        'contract_slots': asyncio.Semaphore(chain.get('max_concurrent_contracts', 4)),
+        'tracker': HeadTracker(lambda: get_block_number(rpc), chain.get('poll_interval', 2.0)),
+        'guard': ReorgGuard(
+            new_session,
+            writer,
+            chain['id'],
+            lambda block_number: get_block_hash(rpc, block_number),
+            chain.get('reorg_depth', 128),
+            chain.get('poll_interval', 2.0)
+        ),
+    }
+
+    if offline:
+        # The head is where the cache ends, and with nothing tracked the
+        # reorg guard never asks the node for block hashes
+        contracts, head = cached_head(cache, contracts)
+        if not contracts:
+            await rpc.close()
+            return
+
+        async def fixed_head():
+            return head
+
+        state.update({
+            'cfg': dict(chain, confirmations=0),
+            'contracts': contracts,
+            'tracker': HeadTracker(fixed_head),
+            'guard': ReorgGuard(new_session, writer, chain['id'], None, depth=0, check_interval=float('inf')),
+        })
 
-            contract['db_contract'].last_processed_block = end_block
-            db_session.commit()
+    try:
+        if follow:
+            await state['tracker'].start()
+        if chain.get('fetch_mode', 'contract') == 'chain' and contracts:
+            await process_contract_group(state)
+        else:
+            await asyncio.gather(*(process_contract(contract, state) for contract in contracts))
+    finally:
+        await state['tracker'].stop()
+        await rpc.close()
 
-            # Update the block range
-            start_block = end_block + 1
 
+async def index(follow=False, offline=False):
+    db_session = new_session()
+    writer = LocalWriter(IndexWriter(db_session, load_config().get('log_cache_dir')))
+    try:
+        await asyncio.gather(*(process_chain(chain, writer, follow, offline) for chain in load_config()['chains']))
+    finally:
         db_session.close()
 
 
+def chain_workers(chain):
+    # A chain with `processes: n` is split into n workers, each indexing
+    # every n-th contract
+    processes = max(1, min(chain.get('processes', 1), len(chain['contracts'])))
+    return [dict(chain, contracts=chain['contracts'][i::processes], worker=i) for i in range(processes)]
 
-async def index():
-    await asyncio.gather(*(process_chain(chain) for chain in cfg['chains']))
+
+def run_worker(chain, follow, requests, replies, worker_id, profile=None, offline=False):
+    try:
+        with instrumented(load_config(), profile, worker=worker_id):
+            asyncio.run(process_chain(chain, RemoteWriter(requests, replies, worker_id), follow, offline))
+    except KeyboardInterrupt:
+        pass
+
+
+def index_processes(follow=False, profile=None, offline=False):
+    """Index every chain in worker processes of its own.
+
+    Workers fetch and decode, and one writer process owns every write to the
+    database. Chain and contract rows are created here first, so the workers
+    start from a database they only read.
+    """
+    cfg = load_config()
+    for chain in cfg['chains']:
+        setup_web3(chain)
+
+    workers = [worker for chain in cfg['chains'] for worker in chain_workers(chain)]
+    context = multiprocessing.get_context('spawn')
+    requests = context.Queue(maxsize=cfg.get('writer_queue_size', 64))
+    replies = [context.Queue() for _ in workers]
+
+    writer = context.Process(target=serve, args=(requests, replies), name='writer')
+    writer.start()
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(chain, follow, requests, replies[worker_id], worker_id, profile, offline),
+            name=f"chain-{chain['id']}-{worker_id}",
+        )
+        for worker_id, chain in enumerate(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    failed = False
+    try:
+        for process in processes:
+            process.join()
+            failed = failed or process.exitcode != 0
+    finally:
+        requests.put(None)
+        writer.join()
+    if failed:
+        raise Exception('One or more chain workers failed')
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index ERC20 Transfer events of the configured contracts.")
+    parser.add_argument('--follow', action='store_true', help="keep running and index new blocks as they arrive")
+    parser.add_argument('--processes', action='store_true', help="index each chain in a worker process of its own")
+    parser.add_argument('--profile', help="write cProfile stats of the run to this file")
+    parser.add_argument('--reindex-from-cache', action='store_true',
+                        help="index only from the log cache, without any request to the node")
+    args = parser.parse_args()
+    if args.follow and args.reindex_from_cache:
+        parser.error("--follow needs the node, it cannot be used with --reindex-from-cache")
+
     try:
-        asyncio.run(index())
+        if args.processes:
+            index_processes(follow=args.follow, profile=args.profile, offline=args.reindex_from_cache)
+        else:
+            with instrumented(load_config(), args.profile):
+                asyncio.run(index(follow=args.follow, offline=args.reindex_from_cache))
     except KeyboardInterrupt:
-        print("\nExiting gracefully...")
\ No newline at end of file
+        log("Exiting gracefully...")
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""Airdrop chunk journal in the airdrop_chunks table of events.db.
+
+Every status change is its own small SQLite transaction, so a run killed at
+any point leaves the journal as it was after the last completed change.
+Lookups by status go through the status index instead of reading every
+chunk ever sent.
+"""
+import json
+import os
+import time
+from sqlalchemy import update
+from database import init_db, AirdropChunk
+from logs import log
+
+
+def transaction_hashes(value):
+    # Every transaction sent for a chunk as a JSON list, a single hash in
+    # journals of older versions
+    if value is None:
+        return []
+    return json.loads(value) if value.startswith('[') else [value]
+
+
+class AirdropJournal:
+    def __init__(self, Session, chain_id, contract_address):
+        self.Session = Session
+        self.chain_id = chain_id
+        self.contract_address = contract_address
+
+    def query(self, db_session, *statuses):
+        return db_session.query(AirdropChunk).filter(
+            AirdropChunk.chain_id == self.chain_id,
+            AirdropChunk.contract_address == self.contract_address,
+            AirdropChunk.status.in_(statuses)
+        )
+
+    def add(self, chunks):
+        """Record chunks as queued. chunks maps ids to {addresses, balances, retry}."""
+        now = time.time()
+        with self.Session() as db_session:
+            db_session.add_all([
+                AirdropChunk(
+                    id=txn_id,
+                    chain_id=self.chain_id,
+                    contract_address=self.contract_address,
+                    status=chunk.get('status', 'queued'),
+                    addresses=json.dumps(chunk['addresses']),
+                    balances=json.dumps(chunk['balances']),
+                    transaction_hash=chunk.get('transaction_hash'),
+                    retry=chunk.get('retry', 0),
+                    updated_at=now,
+                )
+                for txn_id, chunk in chunks.items()
+            ])
+            db_session.commit()
+
+    def add_transaction(self, txn_id, transaction_hash):
+        """Mark a chunk pending on a transaction about to be sent for it.
+
+        Replacements are added next to the earlier hashes, whichever of them
+        gets mined is the chunk's transaction.
+        """
+        with self.Session() as db_session:
+            row = db_session.get(AirdropChunk, txn_id)
+            row.transaction_hash = json.dumps(transaction_hashes(row.transaction_hash) + [transaction_hash])
+            row.status = 'pending'
+            row.updated_at = time.time()
+            db_session.commit()
+
+    def set_status(self, txn_ids, status, failed=False):
+        values = {'status': status, 'updated_at': time.time()}
+        if failed:
+            values['retry'] = AirdropChunk.retry + 1
+        with self.Session() as db_session:
+            db_session.execute(update(AirdropChunk).where(AirdropChunk.id.in_(list(txn_ids))).values(**values))
+            db_session.commit()
+
+    def chunks(self, *statuses):
+        with self.Session() as db_session:
+            return [
+                {
+                    'id': row.id,
+                    'status': row.status,
+                    'addresses': json.loads(row.addresses),
+                    'balances': json.loads(row.balances),
+                    'transaction_hashes': transaction_hashes(row.transaction_hash),
+                    'retry': row.retry,
+                }
+                for row in self.query(db_session, *statuses).all()
+            ]
+
+    def unsent(self):
+        with self.Session() as db_session:
+            return [row.id for row in self.query(db_session, 'queued').with_entities(AirdropChunk.id)]
+
+    def unsettled(self):
+        # (id, transaction hashes) of sent chunks whose outcome may still change on chain
+        with self.Session() as db_session:
+            rows = self.query(db_session, 'pending', 'failed').filter(
+                AirdropChunk.transaction_hash.isnot(None)
+            ).with_entities(AirdropChunk.id, AirdropChunk.transaction_hash).all()
+        return [(txn_id, transaction_hashes(value)) for txn_id, value in rows]
+
+    def pending(self, before):
+        # (id, transaction hashes) of chunks pending since before, a timestamp
+        with self.Session() as db_session:
+            rows = self.query(db_session, 'pending').filter(
+                AirdropChunk.updated_at < before
+            ).with_entities(AirdropChunk.id, AirdropChunk.transaction_hash).all()
+        return [(txn_id, transaction_hashes(value)) for txn_id, value in rows]
+
+    def failed_total(self):
+        with self.Session() as db_session:
+            rows = self.query(db_session, 'failed').with_entities(AirdropChunk.balances)
+            return sum(sum(json.loads(balances)) for balances, in rows)
+
+    def import_legacy(self, path):
+        # One-off move of a {contract}_{chain}_transactions.json log into the
+        # journal. The file is renamed only after the rows are committed.
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r') as file:
+            transactions_log = json.load(file)
+
+        with self.Session() as db_session:
+            known = {
+                txn_id for txn_id, in db_session.query(AirdropChunk.id).filter(
+                    AirdropChunk.id.in_(list(transactions_log))
+                )
+            }
+        self.add({txn_id: chunk for txn_id, chunk in transactions_log.items() if txn_id not in known})
+        os.replace(path, path + '.imported')
+        log(f"Imported {len(transactions_log)} chunks from {path}", chunks=len(transactions_log), path=path)
+
+
+Session = None
+
+
+def get_journal(chain_id, contract_address):
+    global Session
+    if Session is None:
+        Session = init_db()
+    journal = AirdropJournal(Session, chain_id, contract_address)
+    journal.import_legacy(f'{contract_address}_{chain_id}_transactions.json')
+    return journal
@@ -0,0 +1,314 @@
+"""Local store of raw Transfer logs, so re-indexing does not go back to the RPC.
+
+Logs are kept per chain and contract address, as returned by eth_getLogs, in
+append-only segment files under `<log_cache_dir>/<chain id>/<address>/`.
+Every fetched window is one record: a header with the block range, the
+payload length and the SHA-256 of the payload, then the zlib-compressed
+logs. A record is checked against its digest when read.
+
+The indexer stages the logs it fetched and hands them to the writer along
+with the window they belong to. The writer appends them once the window is
+committed and, on a rollback, appends a void marker for everything above the
+fork, so the cache never holds logs the database has forgotten. The writer is
+the only process appending, and it cuts off a torn record left by a crash
+mid-write. Readers pick up new records as they are appended.
+"""
+import hashlib
+import json
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from logs import log
+
+MAGIC = b'LOGR'
+# Voids every record appended before it that reaches past its start block
+VOID = b'LOGX'
+HEADER = struct.Struct('>4sQQI32s')
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class Record:
+    __slots__ = ('start_block', 'end_block', 'path', 'offset', 'length', 'digest')
+
+    def __init__(self, start_block, end_block, path, offset, length, digest):
+        self.start_block = start_block
+        self.end_block = end_block
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+
+
+def pack_logs(logs):
+    # Field names and the address are the same in every log of a record
+    return zlib.compress(json.dumps([
+        [
+            entry['blockNumber'], entry['logIndex'], entry['transactionIndex'],
+            entry['blockHash'], entry['transactionHash'], entry['data'], entry['topics'],
+        ]
+        for entry in logs
+    ], separators=(',', ':')).encode())
+
+
+def unpack_logs(payload, address):
+    return [
+        {
+            'address': address,
+            'blockNumber': block_number,
+            'logIndex': log_index,
+            'transactionIndex': transaction_index,
+            'blockHash': block_hash,
+            'transactionHash': transaction_hash,
+            'data': data,
+            'topics': topics,
+            'removed': False,
+        }
+        for block_number, log_index, transaction_index, block_hash, transaction_hash, data, topics
+        in json.loads(zlib.decompress(payload))
+    ]
+
+
+def trim_payload(payload, last_block):
+    # The logs of a packed record up to last_block
+    return zlib.compress(json.dumps([
+        entry for entry in json.loads(zlib.decompress(payload)) if int(entry[0], 16) <= last_block
+    ], separators=(',', ':')).encode())
+
+
+def scan_segment(path, offset=0, repair=False):
+    """Headers of one segment from offset on, and where the complete ones end.
+
+    A record still being written by another process is left for the next
+    scan. With repair, a torn record at the end is cut off instead.
+    """
+    entries = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        while offset + HEADER.size <= size:
+            file.seek(offset)
+            magic, start_block, end_block, length, digest = HEADER.unpack(file.read(HEADER.size))
+            if magic not in (MAGIC, VOID) or offset + HEADER.size + length > size:
+                break
+            entries.append((magic, Record(start_block, end_block, path, offset + HEADER.size, length, digest)))
+            offset += HEADER.size + length
+    if repair and offset < size:
+        log(f"Truncating torn log cache record at {path}:{offset}", level='warning', path=path, offset=offset)
+        with open(path, 'r+b') as file:
+            file.truncate(offset)
+    return entries, offset
+
+
+class AddressLog:
+    """The segments of one contract address and an index of their records."""
+
+    def __init__(self, directory, repair=False):
+        self.directory = directory
+        self.repair = repair
+        self.segments = []
+        # Bytes of each segment already in the index
+        self.scanned = {}
+        self.records = []
+        self.starts = []
+        # (end block, index) of the furthest reaching record among the first i + 1
+        self.reach = []
+        self.refresh()
+
+    def refresh(self):
+        # Index what was appended since the last call. Only the last segment
+        # is ever appended to, so older ones are never read twice.
+        if not os.path.isdir(self.directory):
+            return
+        first = max(len(self.segments) - 1, 0)
+        self.segments = sorted(name for name in os.listdir(self.directory) if name.endswith('.seg'))
+        for name in self.segments[first:]:
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) == self.scanned.get(path, 0):
+                continue
+            entries, self.scanned[path] = scan_segment(path, self.scanned.get(path, 0), self.repair)
+            for magic, record in entries:
+                if magic == VOID:
+                    self.void_after(record.start_block)
+                else:
+                    self.insert(record)
+
+    def insert(self, record):
+        index = bisect_right(self.starts, record.start_block)
+        self.records.insert(index, record)
+        self.starts.insert(index, record.start_block)
+        # Windows are appended in block order, so this is almost always just the new record
+        self.update_reach(index)
+
+    def void_after(self, block):
+        self.records = [record for record in self.records if record.end_block <= block]
+        self.starts = [record.start_block for record in self.records]
+        self.update_reach(0)
+
+    def update_reach(self, index):
+        del self.reach[index:]
+        for position in range(index, len(self.records)):
+            end_block = self.records[position].end_block
+            if self.reach and self.reach[-1][0] >= end_block:
+                self.reach.append(self.reach[-1])
+            else:
+                self.reach.append((end_block, position))
+
+    def covering(self, block):
+        # The record holding block that reaches the furthest, if any
+        index = bisect_right(self.starts, block) - 1
+        if index < 0 or self.reach[index][0] < block:
+            return None
+        return self.records[self.reach[index][1]]
+
+    def plan(self, start_block, end_block):
+        """Records and the part of each to read for the range, None if not all cached."""
+        parts = []
+        block = start_block
+        while block <= end_block:
+            record = self.covering(block)
+            if record is None:
+                return None
+            parts.append((record, block, min(record.end_block, end_block)))
+            block = record.end_block + 1
+        return parts
+
+    def covered_until(self, start_block):
+        # Last block of the cached run starting at start_block, start_block - 1 if none
+        block = start_block
+        while True:
+            record = self.covering(block)
+            if record is None:
+                return block - 1
+            block = record.end_block + 1
+
+    def load(self, record):
+        # The payload of a record, None if it does not match its digest
+        with open(record.path, 'rb') as file:
+            file.seek(record.offset)
+            payload = file.read(record.length)
+        if hashlib.sha256(payload).digest() != record.digest:
+            log(f"Corrupt log cache record in {record.path}", level='warning', path=record.path)
+            return None
+        return payload
+
+    def write(self, data):
+        os.makedirs(self.directory, exist_ok=True)
+        if not self.segments or os.path.getsize(os.path.join(self.directory, self.segments[-1])) >= SEGMENT_BYTES:
+            self.segments.append(f'{len(self.segments):08d}.seg')
+        with open(os.path.join(self.directory, self.segments[-1]), 'ab') as file:
+            file.write(data)
+
+    def append(self, start_block, end_block, payload):
+        self.write(HEADER.pack(MAGIC, start_block, end_block, len(payload), hashlib.sha256(payload).digest()) + payload)
+        self.refresh()
+
+    def discard_after(self, block):
+        # Void every record reaching past block, then put back the part of
+        # the ones that start at or below it
+        if not self.records or self.reach[-1][0] <= block:
+            return
+        kept = []
+        for record in self.records:
+            if record.start_block <= block < record.end_block:
+                payload = self.load(record)
+                if payload is not None:
+                    kept.append((record.start_block, trim_payload(payload, block)))
+        self.write(HEADER.pack(VOID, block, 0, 0, bytes(32)))
+        self.refresh()
+        for start_block, payload in kept:
+            self.append(start_block, block, payload)
+
+
+class LogCache:
+    """Raw logs of one chain.
+
+    The indexer reads it before eth_getLogs and stages what it fetched until
+    take() hands it to the writer with the window. The writer applies write()
+    and discard_after(). An offline cache is only read, misses are errors
+    instead of requests to the node.
+    """
+
+    def __init__(self, directory, chain_id, offline=False, repair=False):
+        self.directory = os.path.join(directory, str(chain_id))
+        self.offline = offline
+        self.repair = repair
+        self.addresses = {}
+        # address -> fetched (start block, end block, payload) not yet committed
+        self.staged = {}
+
+    def address_log(self, address):
+        if address not in self.addresses:
+            self.addresses[address] = AddressLog(os.path.join(self.directory, address), self.repair)
+        return self.addresses[address]
+
+    def read(self, addresses, start_block, end_block):
+        """Raw logs of the addresses in the range in node order, None unless all cached."""
+        plans = []
+        for address in addresses:
+            address_log = self.address_log(address)
+            address_log.refresh()
+            plans.append((address, address_log, address_log.plan(start_block, end_block)))
+        if any(parts is None for _, _, parts in plans):
+            return None
+
+        logs = []
+        for address, address_log, parts in plans:
+            for record, first, last in parts:
+                payload = address_log.load(record)
+                if payload is None:
+                    return None
+                logs.extend(
+                    entry for entry in unpack_logs(payload, address)
+                    if first <= int(entry['blockNumber'], 16) <= last
+                )
+        if len(addresses) > 1:
+            logs.sort(key=lambda entry: (int(entry['blockNumber'], 16), int(entry['logIndex'], 16)))
+        return logs
+
+    def stage(self, addresses, start_block, end_block, logs):
+        # One record per address, split from a multi-address eth_getLogs
+        by_address = {address.lower(): [] for address in addresses}
+        for entry in logs:
+            if entry['address'].lower() in by_address:
+                by_address[entry['address'].lower()].append(entry)
+        for address in addresses:
+            self.staged.setdefault(address, []).append(
+                (start_block, end_block, pack_logs(by_address[address.lower()]))
+            )
+
+    def take(self, addresses, end_block):
+        """Staged records of the addresses up to end_block, as (address, start, end, payload)."""
+        records = []
+        for address in addresses:
+            pending = []
+            for start_block, last_block, payload in self.staged.pop(address, []):
+                if last_block <= end_block:
+                    records.append((address, start_block, last_block, payload))
+                else:
+                    pending.append((start_block, last_block, payload))
+            if pending:
+                self.staged[address] = pending
+        return records
+
+    def unstage(self, addresses):
+        # Fetched windows that will be fetched again after a restart
+        for address in addresses:
+            self.staged.pop(address, None)
+
+    def write(self, records):
+        for address, start_block, end_block, payload in records:
+            address_log = self.address_log(address)
+            address_log.refresh()
+            if address_log.plan(start_block, end_block) is None:
+                address_log.append(start_block, end_block, payload)
+
+    def discard_after(self, addresses, block):
+        for address in addresses:
+            address_log = self.address_log(address)
+            address_log.refresh()
+            address_log.discard_after(block)
+
+    def covered_until(self, address, start_block):
+        address_log = self.address_log(address)
+        address_log.refresh()
+        return address_log.covered_until(start_block)
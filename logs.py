@@ -0,0 +1,32 @@
+"""Log lines of the indexer, snapshot and airdrop tools.
+
+Plain text by default. With `log_format: json` in config.yml, or LOG_FORMAT=json
+in the environment, every line is a JSON object with time, level and message
+plus the keyword fields of the call, ready for a log shipper.
+"""
+import json
+import os
+import sys
+import time
+
+FORMATS = ('text', 'json')
+log_format = os.environ.get('LOG_FORMAT', 'text')
+
+
+def configure(format=None):
+    global log_format
+    if format is not None:
+        if format not in FORMATS:
+            raise Exception(f"log_format must be one of {', '.join(FORMATS)}, not {format}")
+        log_format = format
+
+
+def log(message, level='info', **fields):
+    if log_format == 'json':
+        record = {'time': round(time.time(), 3), 'level': level, 'message': message}
+        record.update(fields)
+        print(json.dumps(record, default=str), flush=True)
+    elif level == 'error':
+        print(message, file=sys.stderr)
+    else:
+        print(message)
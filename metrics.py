@@ -0,0 +1,283 @@
+"""Run metrics in the Prometheus text exposition format.
+
+Every process keeps its own registry of the metrics defined below. With
+`metrics_port` in config.yml they are served at http://host:port/metrics for
+as long as the run lasts, and with `metrics_file` they are written to that
+file every `metrics_interval` seconds and once more at the end, replacing it
+atomically, so node_exporter's textfile collector can pick them up after a
+one-off run.
+
+Chain workers of `indexer.py --processes` label their metrics with their
+worker number, write to the file with that number before the extension and
+serve on metrics_port + 1 + worker.
+"""
+import contextlib
+import cProfile
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logs
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+registry = []
+# Labels added to every sample of this process
+const_labels = {}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(pairs):
+    pairs = list(const_labels.items()) + list(pairs)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        # (suffix, label pairs, value) for every labelled series
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield '', zip(self.labels, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, pairs, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(pairs)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        # Sets the gauge to the seconds spent in the block
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.set(round(time.perf_counter() - started, 6), **labels)
+
+
+class Meter(Metric):
+    """A gauge of events per second over the last window seconds."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), window=60.0):
+        super().__init__(name, documentation, labels)
+        self.window = window
+
+    def prune(self, marks, now):
+        while marks and marks[0][0] < now - self.window:
+            marks.popleft()
+
+    def mark(self, amount=1, **labels):
+        key = self.key(labels)
+        now = time.monotonic()
+        with self.lock:
+            marks = self.values.setdefault(key, (now, deque()))[1]
+            marks.append((now, amount))
+            # Without an exporter samples() never runs, so marks are dropped here too
+            self.prune(marks, now)
+
+    def samples(self):
+        now = time.monotonic()
+        with self.lock:
+            rates = {}
+            for key, (first, marks) in self.values.items():
+                self.prune(marks, now)
+                # A young series is averaged over its lifetime, not the whole window
+                span = max(min(self.window, now - first), 1e-3)
+                rates[key] = round(sum(amount for _, amount in marks) / span, 3)
+        for key, rate in sorted(rates.items()):
+            yield '', zip(self.labels, key), rate
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', pairs + [('le', format_value(float(bound)))], cumulative
+            yield '_sum', pairs, round(total, 6)
+            yield '_count', pairs, cumulative
+
+
+RPC_REQUESTS = Counter('rpc_requests_total', 'JSON-RPC calls made, a batch counts every call in it', ('chain', 'method'))
+RPC_ERRORS = Counter('rpc_errors_total', 'JSON-RPC calls that failed after every retry', ('chain', 'method'))
+RPC_RETRIES = Counter('rpc_retries_total', 'HTTP requests retried after a failure or throttling', ('chain',))
+RPC_SECONDS = Histogram('rpc_request_seconds', 'Time to answer a JSON-RPC call, retries included', ('chain', 'method'))
+
+INDEXER_LOGS = Counter('indexer_logs_total', 'Transfer logs fetched from the node or the log cache', ('chain',))
+INDEXER_LOGS_RATE = Meter('indexer_logs_per_second', 'Transfer logs fetched per second over the last minute', ('chain',))
+INDEXER_CACHE_HITS = Counter('indexer_log_cache_hits_total', 'eth_getLogs windows served from the log cache', ('chain',))
+INDEXER_ROWS = Counter('indexer_rows_committed_total', 'Event rows committed to the database', ('chain',))
+INDEXER_ROWS_RATE = Meter('indexer_rows_per_second', 'Event rows committed per second over the last minute', ('chain',))
+INDEXER_DECODE_SECONDS = Histogram('indexer_decode_seconds', 'Time to decode the logs of one window', ('chain',))
+INDEXER_COMMIT_SECONDS = Histogram('indexer_commit_seconds', 'Time to write and commit one window', ('chain',))
+INDEXER_HEAD = Gauge('indexer_head_block', 'Latest block the indexer may index up to', ('chain',))
+INDEXER_LAG = Gauge('indexer_lag_blocks', 'Head minus the last processed block', ('chain', 'contract'))
+
+SNAPSHOT_PHASE_SECONDS = Gauge('snapshot_phase_seconds', 'Duration of the latest run of each snapshot phase', ('phase',))
+
+AIRDROP_IN_FLIGHT = Gauge('airdrop_transactions_in_flight', 'Airdrop transactions sent and waiting for a receipt', ('chain',))
+AIRDROP_TRANSACTIONS = Counter('airdrop_transactions_total', 'Airdrop transactions by outcome', ('chain', 'status'))
+AIRDROP_REPLACEMENTS = Counter('airdrop_replacements_total', 'Stuck airdrop transactions sent again', ('chain', 'kind'))
+AIRDROP_CONFIRMATION_SECONDS = Histogram(
+    'airdrop_confirmation_seconds', 'Time from sending an airdrop transaction to its receipt', ('chain',)
+)
+
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+def write_file(path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(render())
+    os.replace(temp_path, path)
+
+
+def serve(port, host=''):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def with_suffix(path, suffix):
+    root, extension = os.path.splitext(path)
+    return f'{root}.{suffix}{extension}'
+
+
+@contextlib.contextmanager
+def instrumented(cfg, profile=None, worker=None):
+    """Logging, metrics export and optional profiling for one run.
+
+    profile is a path for the cProfile stats of the run, to read with pstats
+    or snakeviz.
+    """
+    logs.configure(cfg.get('log_format'))
+    path = cfg.get('metrics_file')
+    port = cfg.get('metrics_port')
+    if worker is not None:
+        const_labels['worker'] = str(worker)
+        path = path and with_suffix(path, worker)
+        port = port and port + 1 + worker
+        profile = profile and with_suffix(profile, worker)
+
+    server = serve(port) if port else None
+    stopped = threading.Event()
+
+    def write_periodically():
+        while not stopped.wait(cfg.get('metrics_interval', 15)):
+            write_file(path)
+
+    if path:
+        threading.Thread(target=write_periodically, daemon=True).start()
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile)
+            logs.log(f"Profile written to {profile}", path=profile)
+        stopped.set()
+        if path:
+            write_file(path)
+        if server:
+            server.shutdown()
+            server.server_close()
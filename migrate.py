@@ -0,0 +1,103 @@
+"""Upgrade an events.db written with the text events layout.
+
+Addresses move into the addresses table, values and transaction hashes are
+stored as 32-byte big-endian blobs, and events are clustered by contract and
+block. The old layout has no log index, so migrated events are numbered in
+their original insertion order within each block.
+
+The whole upgrade runs in one transaction, an interrupted run leaves the
+database untouched.
+"""
+import sqlite3
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable
+from database import DB_PATH, Address, Event, encode_value, hex_to_bytes
+from logs import log
+
+BATCH_SIZE = 100000
+
+
+def needs_migration(conn):
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(events)')]
+    return 'from_address' in columns
+
+
+def migrate(path=DB_PATH):
+    conn = sqlite3.connect(path, isolation_level=None)
+    if not needs_migration(conn):
+        log(f"{path} already uses the compact events layout", path=path)
+        conn.close()
+        return
+
+    total = conn.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+    log(f"Migrating {total} events in {path}...", path=path, events=total)
+
+    conn.execute('BEGIN')
+    try:
+        conn.execute('ALTER TABLE events RENAME TO events_v1')
+        for table in (Address.__table__, Event.__table__):
+            conn.execute(str(CreateTable(table, if_not_exists=True).compile(dialect=sqlite.dialect())))
+
+        address_ids = {}
+
+        def address_id(address):
+            if address not in address_ids:
+                raw = hex_to_bytes(address)
+                conn.execute('INSERT OR IGNORE INTO addresses (address) VALUES (?)', (raw,))
+                address_ids[address] = conn.execute('SELECT id FROM addresses WHERE address = ?', (raw,)).fetchone()[0]
+            return address_ids[address]
+
+        reader = conn.cursor()
+        reader.execute(
+            'SELECT contract_id, block_number, from_address, to_address, value, transaction_hash '
+            'FROM events_v1 ORDER BY contract_id, block_number, id'
+        )
+
+        migrated = 0
+        last_block = None
+        log_index = 0
+        while True:
+            batch = reader.fetchmany(BATCH_SIZE)
+            if not batch:
+                break
+
+            rows = []
+            for contract_id, block_number, from_address, to_address, value, transaction_hash in batch:
+                if (contract_id, block_number) != last_block:
+                    last_block = (contract_id, block_number)
+                    log_index = 0
+                rows.append((
+                    contract_id,
+                    block_number,
+                    log_index,
+                    address_id(from_address),
+                    address_id(to_address),
+                    encode_value(value),
+                    hex_to_bytes(transaction_hash),
+                ))
+                log_index += 1
+
+            conn.executemany(
+                'INSERT OR IGNORE INTO events '
+                '(contract_id, block_number, log_index, from_id, to_id, value, transaction_hash) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            migrated += len(rows)
+            log(f"Migrated {migrated}/{total} events", migrated=migrated, events=total)
+
+        conn.execute('DROP TABLE events_v1')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        conn.close()
+        raise
+
+    log("Reclaiming space...")
+    conn.execute('VACUUM')
+    conn.close()
+    log("Migration complete", path=path)
+
+
+if __name__ == "__main__":
+    migrate()
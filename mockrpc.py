@@ -0,0 +1,405 @@
+"""A small in-memory JSON-RPC node for exercising the indexer and airdrop.
+
+Serves eth_chainId, eth_blockNumber, eth_getBlockByNumber, eth_getLogs and
+eth_getTransactionReceipt from whatever the caller puts in the node, over
+plain HTTP, for single and batch requests. Batches can be turned off to
+behave like providers that reject them.
+
+For the airdrop it also takes signed transactions through
+eth_sendRawTransaction and mines them block_time seconds later, in nonce
+order, the highest gas price winning a replaced nonce, and answers
+eth_getTransactionByHash for the ones mined or waiting. eth_call answers
+balanceOf from set_balance, and eth_estimateGas charges gas_per_byte for
+every byte of calldata on top of 21000. A transaction sent with less gas
+than that is mined with status 0.
+
+latency and jitter delay every HTTP request, error_rate answers that share
+of them with error_status instead, and drop_rate silently drops that share
+of sent transactions until they are replaced.
+
+    node = MockNode(chain_id=250, head=1000)
+    node.add_transfer(block_number=10, token=..., sender=..., receiver=..., value=5)
+    url = node.start()
+    ...
+    node.stop()
+"""
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rlp
+from eth_account import Account
+from hexbytes import HexBytes
+from web3 import Web3
+from decoder import TRANSFER_TOPIC_HEX
+
+BALANCE_OF_SELECTOR = '0x70a08231'
+
+
+def to_hex(value):
+    return hex(value)
+
+
+def pad_address(address):
+    return '0x' + '0' * 24 + address[2:].lower()
+
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def to_int(field):
+    return int.from_bytes(field, 'big')
+
+
+def decode_transaction(raw):
+    # Legacy, EIP-2930 and EIP-1559 transactions, just the fields the node uses
+    raw = HexBytes(raw)
+    if raw[0] >= 0xc0:
+        nonce, gas_price, gas, to, value, data = rlp.decode(raw)[:6]
+    elif raw[0] == 1:
+        nonce, gas_price, gas, to, value, data = rlp.decode(raw[1:])[1:7]
+    elif raw[0] == 2:
+        fields = rlp.decode(raw[1:])
+        nonce, gas_price, gas, to, value, data = fields[1], fields[3], *fields[4:8]
+    else:
+        raise RpcError(-32000, f"transaction type {raw[0]} not supported")
+    return {
+        'hash': Web3.to_hex(Web3.keccak(raw)),
+        'from': Account.recover_transaction(raw).lower(),
+        'nonce': to_int(nonce),
+        'gasPrice': to_int(gas_price),
+        'gas': to_int(gas),
+        'to': Web3.to_hex(to) if to else None,
+        'value': to_int(value),
+        'data': bytes(data),
+    }
+
+
+class MockNode:
+    def __init__(self, chain_id=1, head=0, batching=True, max_batch=None, max_range=None, latency=0.0,
+                 jitter=0.0, error_rate=0.0, error_status=429, drop_rate=0.0, block_time=0.0,
+                 gas_price=10**9, gas_per_byte=400, seed=None):
+        self.chain_id = chain_id
+        self.head = head
+        self.batching = batching
+        self.max_batch = max_batch
+        self.max_range = max_range
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.block_time = block_time
+        self.gas_price = gas_price
+        self.gas_per_byte = gas_per_byte
+        self.random = random.Random(seed)
+        # Logs in block order, log_blocks holds their block numbers for bisect
+        self.logs = []
+        self.log_blocks = []
+        self.receipts = {}
+        # Mined transactions by hash
+        self.transactions = {}
+        self.balances = {}
+        self.mempool = {}
+        self.nonces = {}
+        self.requests = 0
+        self.calls = 0
+        self.errors = 0
+        self.sent = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def block_hash(self, block_number):
+        return '0x' + Web3.keccak(text=f"{self.chain_id}:{block_number}").hex().removeprefix('0x')
+
+    def add_transfer(self, block_number, token, sender, receiver, value):
+        with self.lock:
+            position = bisect.bisect_right(self.log_blocks, block_number)
+            log_index = position - bisect.bisect_left(self.log_blocks, block_number)
+            tx_hash = '0x' + Web3.keccak(text=f"{block_number}:{log_index}:{token}").hex().removeprefix('0x')
+            self.log_blocks.insert(position, block_number)
+            self.logs.insert(position, {
+                'address': token.lower(),
+                'blockHash': self.block_hash(block_number),
+                'blockNumber': to_hex(block_number),
+                'data': '0x' + value.to_bytes(32, 'big').hex(),
+                'logIndex': to_hex(log_index),
+                'removed': False,
+                'topics': [TRANSFER_TOPIC_HEX, pad_address(sender), pad_address(receiver)],
+                'transactionHash': tx_hash,
+                'transactionIndex': to_hex(log_index),
+            })
+            self.head = max(self.head, block_number)
+
+    def add_receipt(self, tx_hash, block_number, status=1, gas_used=21000):
+        with self.lock:
+            self.receipts[tx_hash.lower()] = {
+                'transactionHash': tx_hash.lower(),
+                'blockHash': self.block_hash(block_number),
+                'blockNumber': to_hex(block_number),
+                'gasUsed': to_hex(gas_used),
+                'status': to_hex(status),
+                'logs': [],
+            }
+
+    def set_balance(self, token, holder, value):
+        with self.lock:
+            self.balances.setdefault(token.lower(), {})[holder.lower()] = value
+
+    def required_gas(self, data):
+        return 21000 + self.gas_per_byte * len(data)
+
+    def mine(self):
+        # Mine every transaction that is due into one new block
+        with self.lock:
+            now = time.monotonic()
+            mined = []
+            progress = True
+            while progress:
+                progress = False
+                for (sender, nonce), candidates in list(self.mempool.items()):
+                    if nonce != self.nonces.get(sender, 0):
+                        continue
+                    due = [txn for txn in candidates if txn['due'] <= now and not txn['dropped']]
+                    if not due:
+                        continue
+                    mined.append(max(due, key=lambda txn: txn['gasPrice']))
+                    del self.mempool[(sender, nonce)]
+                    self.nonces[sender] = nonce + 1
+                    progress = True
+            if not mined:
+                return
+
+            self.head += 1
+            for txn in mined:
+                self.transactions[txn['hash']] = txn
+                required = self.required_gas(txn['data'])
+                self.receipts[txn['hash']] = {
+                    'transactionHash': txn['hash'],
+                    'blockHash': self.block_hash(self.head),
+                    'blockNumber': to_hex(self.head),
+                    'from': txn['from'],
+                    'to': txn['to'],
+                    'gasUsed': to_hex(min(required, txn['gas'])),
+                    'status': to_hex(1 if txn['gas'] >= required else 0),
+                    'logs': [],
+                }
+
+    def eth_chainId(self):
+        return to_hex(self.chain_id)
+
+    def eth_blockNumber(self):
+        return to_hex(self.head)
+
+    def eth_getBlockByNumber(self, block, full=False):
+        number = self.head if block == 'latest' else int(block, 16)
+        if number > self.head:
+            return None
+        return {
+            'number': to_hex(number),
+            'hash': self.block_hash(number),
+            'parentHash': self.block_hash(number - 1),
+            'timestamp': to_hex(number),
+            'gasLimit': to_hex(30000000),
+            'transactions': [],
+        }
+
+    def eth_getLogs(self, params):
+        start = int(params.get('fromBlock', '0x0'), 16)
+        end = self.head if params.get('toBlock', 'latest') == 'latest' else int(params['toBlock'], 16)
+        if self.max_range is not None and end - start + 1 > self.max_range:
+            raise RpcError(-32005, "query returned more than 10000 results, block range too large")
+
+        addresses = params.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = {address.lower() for address in addresses} if addresses else None
+        topic = (params.get('topics') or [None])[0]
+
+        with self.lock:
+            first = bisect.bisect_left(self.log_blocks, start)
+            last = bisect.bisect_right(self.log_blocks, end)
+            return [
+                log for log in self.logs[first:last]
+                if (addresses is None or log['address'] in addresses)
+                and (topic is None or log['topics'][0] == topic)
+            ]
+
+    def eth_getTransactionReceipt(self, tx_hash):
+        self.mine()
+        return self.receipts.get(tx_hash.lower())
+
+    def eth_getTransactionByHash(self, tx_hash):
+        # Mined or waiting, a dropped transaction is unknown as on a real node
+        self.mine()
+        tx_hash = tx_hash.lower()
+        with self.lock:
+            txn = self.transactions.get(tx_hash)
+            block_number = self.receipts[tx_hash]['blockNumber'] if txn else None
+            if txn is None:
+                waiting = [other for candidates in self.mempool.values() for other in candidates]
+                txn = next((other for other in waiting if other['hash'] == tx_hash and not other['dropped']), None)
+        if txn is None:
+            return None
+        return {
+            'hash': txn['hash'],
+            'from': txn['from'],
+            'to': txn['to'],
+            'nonce': to_hex(txn['nonce']),
+            'gasPrice': to_hex(txn['gasPrice']),
+            'gas': to_hex(txn['gas']),
+            'value': to_hex(txn['value']),
+            'blockNumber': block_number,
+        }
+
+    def eth_gasPrice(self):
+        return to_hex(self.gas_price)
+
+    def eth_getTransactionCount(self, address, block='latest'):
+        self.mine()
+        address = address.lower()
+        with self.lock:
+            count = self.nonces.get(address, 0)
+            if block == 'pending':
+                while (address, count) in self.mempool:
+                    count += 1
+        return to_hex(count)
+
+    def eth_estimateGas(self, transaction, block=None):
+        return to_hex(self.required_gas(HexBytes(transaction.get('data', transaction.get('input', '0x')))))
+
+    def eth_call(self, transaction, block=None):
+        data = transaction.get('data', transaction.get('input', '0x'))
+        if not data.startswith(BALANCE_OF_SELECTOR):
+            raise RpcError(-32000, "execution reverted")
+        holder = '0x' + data[-40:].lower()
+        with self.lock:
+            balance = self.balances.get(transaction['to'].lower(), {}).get(holder, 0)
+        return '0x' + balance.to_bytes(32, 'big').hex()
+
+    def eth_sendRawTransaction(self, raw):
+        txn = decode_transaction(raw)
+        self.mine()
+        with self.lock:
+            key = (txn['from'], txn['nonce'])
+            if txn['nonce'] < self.nonces.get(txn['from'], 0):
+                raise RpcError(-32000, "nonce too low")
+            replaced = self.mempool.get(key, [])
+            if any(txn['hash'] == other['hash'] for other in replaced):
+                raise RpcError(-32000, "already known")
+            if replaced and txn['gasPrice'] < max(other['gasPrice'] for other in replaced) * 1.1:
+                raise RpcError(-32000, "replacement transaction underpriced")
+
+            txn['due'] = time.monotonic() + self.block_time
+            txn['dropped'] = self.random.random() < self.drop_rate
+            self.mempool[key] = replaced + [txn]
+            self.sent += 1
+        return txn['hash']
+
+    def fault(self):
+        # Whether to answer this HTTP request with error_status
+        if not self.error_rate:
+            return False
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            self.errors += failed
+        return failed
+
+    def answer(self, request):
+        try:
+            method = getattr(self, request['method'], None)
+            if method is None or not request['method'].startswith('eth_'):
+                raise RpcError(-32601, f"the method {request['method']} does not exist")
+            result = method(*request.get('params', []))
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+        except RpcError as exc:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': exc.code, 'message': exc.message}}
+
+    def handle(self, body):
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+
+        if not isinstance(body, list):
+            with self.lock:
+                self.calls += 1
+            return self.answer(body)
+
+        if not self.batching:
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'batch requests are not supported'}}
+        if self.max_batch is not None and len(body) > self.max_batch:
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': f'batch larger than {self.max_batch}'}}
+        with self.lock:
+            self.calls += len(body)
+        return [self.answer(request) for request in body]
+
+    def start(self, host='127.0.0.1', port=0):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if node.fault():
+                    status = node.error_status
+                    response = json.dumps({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32005, 'message': 'too many requests'}}).encode()
+                else:
+                    status = 200
+                    response = json.dumps(node.handle(json.loads(body))).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve an empty mock JSON-RPC node.")
+    parser.add_argument('--port', type=int, default=8545)
+    parser.add_argument('--chain-id', type=int, default=1)
+    parser.add_argument('--head', type=int, default=0)
+    parser.add_argument('--no-batch', action='store_true', help="reject batch requests")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every HTTP request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of HTTP requests answered with HTTP 429")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="share of sent transactions never mined")
+    parser.add_argument('--block-time', type=float, default=0.0, help="seconds before a sent transaction is mined")
+    parser.add_argument('--seed', type=int, help="seed for the injected errors and drops")
+    args = parser.parse_args()
+
+    node = MockNode(
+        args.chain_id, args.head, batching=not args.no_batch, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, drop_rate=args.drop_rate, block_time=args.block_time, seed=args.seed
+    )
+    print(f"Mock node listening on {node.start(port=args.port)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        node.stop()
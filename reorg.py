@@ -0,0 +1,88 @@
+import asyncio
+import time
+from checkpoints import invalidate_checkpoints
+from database import BlockHash, Contract, Event
+from logs import log
+
+
+class ReorgDetected(Exception):
+    """A contract's cursor was rolled back while its windows were in flight."""
+
+
+def rollback(db_session, chain_id, fork_block):
+    # Forget everything above the last block both chains agree on
+    for db_contract in db_session.query(Contract).filter_by(chain_id=chain_id).all():
+        if db_contract.last_processed_block <= fork_block:
+            continue
+        db_session.query(Event).filter(
+            Event.contract_id == db_contract.id,
+            Event.block_number > fork_block
+        ).delete(synchronize_session=False)
+        invalidate_checkpoints(db_session, db_contract.id, fork_block + 1)
+        db_contract.last_processed_block = fork_block
+
+    db_session.query(BlockHash).filter(
+        BlockHash.chain_id == chain_id,
+        BlockHash.block_number > fork_block
+    ).delete(synchronize_session=False)
+    db_session.commit()
+
+
+class ReorgGuard:
+    """Records hashes of recently indexed blocks and rolls back on a fork.
+
+    Only the last `depth` blocks below the head are tracked. check() compares
+    the newest recorded hash with the node and, on a mismatch, walks back
+    through the recorded hashes to the fork point. Events above it are
+    deleted so only that short range is fetched again.
+
+    Hashes are read from short-lived sessions of Session and every change goes
+    through the indexer's writer.
+    """
+
+    def __init__(self, Session, writer, chain_id, get_block_hash, depth=128, check_interval=2.0):
+        self.Session = Session
+        self.writer = writer
+        self.chain_id = chain_id
+        self.get_block_hash = get_block_hash
+        self.depth = depth
+        self.check_interval = check_interval
+        self.lock = asyncio.Lock()
+        self.checked = 0.0
+
+    def tracks(self, block_number, head):
+        return self.depth > 0 and block_number > head - self.depth
+
+    def recorded(self):
+        with self.Session() as db_session:
+            return db_session.query(BlockHash.block_number, BlockHash.hash).filter(
+                BlockHash.chain_id == self.chain_id
+            ).order_by(BlockHash.block_number.desc()).all()
+
+    async def check(self, head):
+        async with self.lock:
+            # Contracts of the same chain share one check per interval
+            if time.monotonic() - self.checked < self.check_interval:
+                return None
+            self.checked = time.monotonic()
+
+            await self.writer.call('prune_hashes', self.chain_id, head - self.depth + 1)
+
+            rows = self.recorded()
+            if not rows or await self.get_block_hash(rows[0].block_number) == rows[0].hash:
+                return None
+
+            # No recorded hash still matches, so nothing within the tracked
+            # depth can be trusted
+            fork_block = head - self.depth
+            for row in rows[1:]:
+                if await self.get_block_hash(row.block_number) == row.hash:
+                    fork_block = row.block_number
+                    break
+
+            log(
+                f"Reorg detected on chain {self.chain_id}, rolling back to block {fork_block}",
+                level='warning', chain=self.chain_id, fork_block=fork_block
+            )
+            await self.writer.call('rollback', self.chain_id, fork_block)
+            return fork_block
@@ -0,0 +1,545 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import aiohttp
+import requests
+from hexbytes import HexBytes
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.middleware import geth_poa_middleware
+from web3.providers.base import JSONBaseProvider
+from metrics import RPC_ERRORS, RPC_REQUESTS, RPC_RETRIES, RPC_SECONDS
+
+# Calls per JSON-RPC batch when a chain does not set rpc_batch_size
+DEFAULT_BATCH_SIZE = 20
+
+# JSON-RPC errors that mean "slow down" rather than "bad request"
+THROTTLE_MARKERS = ('rate limit', 'too many requests', 'capacity', 'throttl')
+
+
+class RetryableError(Exception):
+    pass
+
+
+class RequestRejected(Exception):
+    """The node refused the request itself, another endpoint would too."""
+
+
+class BatchUnsupported(Exception):
+    pass
+
+
+def is_throttled(raw):
+    head = raw[:512]
+    if b'"error"' not in head:
+        return False
+    message = head.decode('utf-8', 'replace').lower()
+    return any(marker in message for marker in THROTTLE_MARKERS)
+
+
+class Endpoint:
+    """One RPC URL with its own keep-alive session, rate budget and health."""
+
+    def __init__(self, url, weight=1.0, rps=None, timeout=30, pool_size=32):
+        self.url = url
+        self.weight = weight
+        self.rps = rps
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+        self.lock = threading.Lock()
+        self.tokens = float(rps) if rps else 0.0
+        self.refilled = time.monotonic()
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+        # Set to False the first time the endpoint answers a batch with
+        # anything but a list
+        self.batching = None
+
+    def reserve(self):
+        # Token bucket holding up to one second of budget. Returns how long
+        # the caller has to wait before its request fits in the budget.
+        if not self.rps:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rps, self.tokens + (now - self.refilled) * self.rps)
+            self.refilled = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rps
+
+    def queue_delay(self):
+        if not self.rps:
+            return 0.0
+        with self.lock:
+            tokens = min(self.rps, self.tokens + (time.monotonic() - self.refilled) * self.rps)
+            return 0.0 if tokens >= 1 else (1 - tokens) / self.rps
+
+    def healthy(self, now):
+        return now >= self.down_until
+
+    def succeeded(self, latency):
+        with self.lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.failures = 0
+            self.down_until = 0.0
+
+    def failed(self):
+        # A few failures in a row take the endpoint out of rotation for a
+        # growing cool-down
+        with self.lock:
+            self.failures += 1
+            if self.failures >= 3:
+                self.down_until = time.monotonic() + min(60.0, 2.0 ** (self.failures - 2))
+
+    def post(self, payload):
+        response = self.session.post(self.url, data=payload, timeout=self.timeout)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableError(f"{self.url} returned HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise RequestRejected(f"{self.url} returned HTTP {response.status_code}: {response.text[:200]}")
+        return response.content
+
+    async def apost(self, session, payload):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with session.post(self.url, data=payload, timeout=timeout) as response:
+            if response.status == 429 or response.status >= 500:
+                raise RetryableError(f"{self.url} returned HTTP {response.status}")
+            if response.status >= 400:
+                raise RequestRejected(f"{self.url} returned HTTP {response.status}: {(await response.text())[:200]}")
+            return await response.read()
+
+
+class RpcPool:
+    """Spreads JSON-RPC requests over several endpoints of one chain.
+
+    Endpoints are picked at random, weighted by their configured weight over
+    their recent latency plus any wait for their rate budget. Failed requests
+    are retried on another endpoint with jittered exponential backoff, and an
+    endpoint that keeps failing is skipped until its cool-down ends.
+
+    Only throttling, 5xx answers and connection errors count as failures.
+    Other 4xx answers go straight back to the caller. A read timeout is
+    retried once without counting against the endpoint, as it is usually a
+    request too heavy for any node, like an eth_getLogs window the caller
+    should split.
+    """
+
+    def __init__(self, endpoints, max_retries=5, backoff=0.5, max_backoff=30.0, chain=''):
+        if not endpoints:
+            raise Exception('RPC pool needs at least one endpoint')
+        self.endpoints = endpoints
+        self.chain = chain
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def choose(self, exclude=None, batch=False):
+        now = time.monotonic()
+        endpoints = self.endpoints
+        if batch:
+            endpoints = [endpoint for endpoint in endpoints if endpoint.batching is not False]
+            if not endpoints:
+                raise BatchUnsupported('No endpoint of this chain accepts batch requests')
+
+        candidates = [endpoint for endpoint in endpoints if endpoint.healthy(now) and endpoint is not exclude]
+        if not candidates:
+            candidates = [endpoint for endpoint in endpoints if endpoint.healthy(now)]
+        if not candidates:
+            # Everything is cooling down, use whichever comes back first
+            return min(endpoints, key=lambda endpoint: endpoint.down_until)
+
+        known = [endpoint.latency for endpoint in candidates if endpoint.latency is not None]
+        default_latency = sum(known) / len(known) if known else 0.1
+        scores = [
+            endpoint.weight / ((endpoint.latency if endpoint.latency is not None else default_latency) + endpoint.queue_delay())
+            for endpoint in candidates
+        ]
+        return random.choices(candidates, weights=scores)[0]
+
+    def observe(self, methods, started, failed=False):
+        # Every call of a batch gets the latency of the whole request
+        seconds = time.perf_counter() - started
+        for method in methods:
+            RPC_REQUESTS.inc(chain=self.chain, method=method)
+            RPC_SECONDS.observe(seconds, chain=self.chain, method=method)
+            if failed:
+                RPC_ERRORS.inc(chain=self.chain, method=method)
+
+    def post(self, payload, batch=False, methods=(), retries=None):
+        """Send payload, a JSON-RPC request or batch, and return the raw response.
+
+        methods names the calls in the payload for the metrics. retries
+        overrides max_retries, 0 for calls that must not reach a node twice.
+        """
+        started = time.perf_counter()
+        try:
+            raw = self.send(payload, batch, retries)
+        except BatchUnsupported:
+            raise
+        except Exception:
+            self.observe(methods, started, failed=True)
+            raise
+        self.observe(methods, started)
+        return raw
+
+    async def apost(self, session, payload, batch=False, methods=()):
+        started = time.perf_counter()
+        try:
+            raw = await self.asend(session, payload, batch)
+        except BatchUnsupported:
+            raise
+        except Exception:
+            self.observe(methods, started, failed=True)
+            raise
+        self.observe(methods, started)
+        return raw
+
+    def send(self, payload, batch=False, retries=None):
+        last_error = None
+        endpoint = None
+        timed_out = False
+        for attempt in range((self.max_retries if retries is None else retries) + 1):
+            endpoint = self.choose(exclude=endpoint, batch=batch)
+            time.sleep(endpoint.reserve())
+
+            started = time.monotonic()
+            try:
+                raw = endpoint.post(payload)
+                if is_throttled(raw):
+                    raise RetryableError(f"{endpoint.url} is throttling requests")
+                if batch and not raw.lstrip().startswith(b'['):
+                    # Not an outage, the endpoint just does not do batches
+                    endpoint.batching = False
+                    endpoint.succeeded(time.monotonic() - started)
+                    return self.send(payload, batch=True, retries=retries)
+            except requests.ReadTimeout as exc:
+                if timed_out:
+                    raise
+                timed_out = True
+                last_error = exc
+                RPC_RETRIES.inc(chain=self.chain)
+                continue
+            except (requests.RequestException, RetryableError) as exc:
+                endpoint.failed()
+                last_error = exc
+                RPC_RETRIES.inc(chain=self.chain)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(random.uniform(0, delay))
+                continue
+
+            endpoint.succeeded(time.monotonic() - started)
+            if batch:
+                endpoint.batching = True
+            return raw
+
+        raise last_error
+
+    async def asend(self, session, payload, batch=False):
+        # Same endpoint choice, budgets and retries as send, without blocking
+        # the event loop
+        last_error = None
+        endpoint = None
+        timed_out = False
+        for attempt in range(self.max_retries + 1):
+            endpoint = self.choose(exclude=endpoint, batch=batch)
+            await asyncio.sleep(endpoint.reserve())
+
+            started = time.monotonic()
+            try:
+                raw = await endpoint.apost(session, payload)
+                if is_throttled(raw):
+                    raise RetryableError(f"{endpoint.url} is throttling requests")
+                if batch and not raw.lstrip().startswith(b'['):
+                    endpoint.batching = False
+                    endpoint.succeeded(time.monotonic() - started)
+                    return await self.asend(session, payload, batch=True)
+            except asyncio.TimeoutError as exc:
+                if timed_out:
+                    raise
+                timed_out = True
+                last_error = exc
+                RPC_RETRIES.inc(chain=self.chain)
+                continue
+            except (aiohttp.ClientError, RetryableError) as exc:
+                endpoint.failed()
+                last_error = exc
+                RPC_RETRIES.inc(chain=self.chain)
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                await asyncio.sleep(random.uniform(0, delay))
+                continue
+
+            endpoint.succeeded(time.monotonic() - started)
+            if batch:
+                endpoint.batching = True
+            return raw
+
+        raise last_error
+
+    def request(self, method, params):
+        return json.loads(self.post(encode_request(method, params), methods=(method,)))
+
+    def request_batch(self, calls):
+        """Send (method, params) calls as one JSON-RPC batch.
+
+        Returns the response objects in call order, matched back by id.
+        Raises BatchUnsupported when no endpoint answers batches properly.
+        """
+        raw = self.post(encode_batch(calls), batch=True, methods=[method for method, _ in calls])
+        return match_batch(json.loads(raw), len(calls))
+
+
+def encode_request(method, params):
+    return json.dumps({'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params}).encode()
+
+
+def encode_batch(calls):
+    return json.dumps([
+        {'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params}
+        for request_id, (method, params) in enumerate(calls)
+    ]).encode()
+
+
+def match_batch(responses, count):
+    by_id = {response.get('id'): response for response in responses}
+    if len(by_id) != count or any(request_id not in by_id for request_id in range(count)):
+        raise BatchUnsupported('Batch response does not answer every request')
+    return [by_id[request_id] for request_id in range(count)]
+
+
+class BatchClient:
+    """Runs many independent JSON-RPC calls in batches of at most batch_size.
+
+    Falls back to one request per call on chains whose endpoints reject
+    batches. Returns raw response objects holding either result or error.
+    """
+
+    def __init__(self, pool, batch_size=DEFAULT_BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+
+    def call_many(self, calls):
+        responses = []
+        for i in range(0, len(calls), self.batch_size):
+            chunk = calls[i:i + self.batch_size]
+            if len(chunk) > 1:
+                try:
+                    responses.extend(self.pool.request_batch(chunk))
+                    continue
+                except BatchUnsupported:
+                    pass
+            responses.extend(self.pool.request(method, params) for method, params in chunk)
+        return responses
+
+
+class AsyncRpcClient:
+    """JSON-RPC over aiohttp on one chain's endpoint pool.
+
+    At most max_concurrency requests of the chain are in flight at once, so a
+    slow chain holds its own slots and no one else's. Create it inside the
+    event loop that uses it and close() it when done.
+    """
+
+    def __init__(self, pool, max_concurrency=16, batch_size=DEFAULT_BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_concurrency),
+            headers={'Content-Type': 'application/json'},
+        )
+
+    async def post(self, payload, batch=False, methods=()):
+        async with self.slots:
+            return await self.pool.apost(self.session, payload, batch, methods)
+
+    async def request(self, method, params):
+        return json.loads(await self.post(encode_request(method, params), methods=(method,)))
+
+    async def call(self, method, params):
+        return unwrap(await self.request(method, params))
+
+    async def call_many(self, calls):
+        # Batches of at most batch_size, single calls on chains that reject them
+        responses = []
+        for i in range(0, len(calls), self.batch_size):
+            chunk = calls[i:i + self.batch_size]
+            if len(chunk) > 1:
+                try:
+                    raw = await self.post(encode_batch(chunk), batch=True, methods=[method for method, _ in chunk])
+                    responses.extend(match_batch(json.loads(raw), len(chunk)))
+                    continue
+                except BatchUnsupported:
+                    pass
+            responses.extend(await asyncio.gather(*(self.request(method, params) for method, params in chunk)))
+        return responses
+
+    async def close(self):
+        await self.session.close()
+
+
+class CallBatcher:
+    """Coalesces calls made from concurrent coroutines into JSON-RPC batches.
+
+    A call waits up to linger seconds for company, a full batch goes out
+    straight away.
+    """
+
+    def __init__(self, client, linger=0.005):
+        self.client = client
+        self.linger = linger
+        self.pending = []
+        self.timer = None
+
+    async def call(self, method, params):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((method, params, future))
+        if len(self.pending) >= self.client.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.linger, self.flush)
+        return unwrap(await future)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        calls, self.pending = self.pending, []
+        if calls:
+            asyncio.ensure_future(self.send(calls))
+
+    async def send(self, calls):
+        try:
+            responses = await self.client.call_many([(method, params) for method, params, _ in calls])
+        except Exception as exc:
+            for _, _, future in calls:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (_, _, future), response in zip(calls, responses):
+            if not future.done():
+                future.set_result(response)
+
+
+def unwrap(response):
+    # Same error shape web3 raises for a failed call
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response['result']
+
+
+def format_log(log):
+    # Raw JSON log into the shape web3's get_logs returns
+    return {
+        'address': Web3.to_checksum_address(log['address']),
+        'blockHash': HexBytes(log['blockHash']),
+        'blockNumber': int(log['blockNumber'], 16),
+        'data': HexBytes(log['data']),
+        'logIndex': int(log['logIndex'], 16),
+        'removed': log.get('removed', False),
+        'topics': [HexBytes(topic) for topic in log['topics']],
+        'transactionHash': HexBytes(log['transactionHash']),
+        'transactionIndex': int(log['transactionIndex'], 16),
+    }
+
+
+def format_receipt(receipt):
+    if receipt is None:
+        return None
+    return {
+        'transactionHash': HexBytes(receipt['transactionHash']),
+        'blockNumber': int(receipt['blockNumber'], 16),
+        'gasUsed': int(receipt['gasUsed'], 16),
+        'status': int(receipt['status'], 16),
+    }
+
+
+def encode_filter(filter_params):
+    encoded = dict(filter_params)
+    for key in ('fromBlock', 'toBlock'):
+        if isinstance(encoded.get(key), int):
+            encoded[key] = hex(encoded[key])
+    return encoded
+
+
+def get_receipts(chain_cfg, transaction_hashes):
+    # Receipts for many transactions in as few round-trips as possible,
+    # None for the ones that are not mined yet
+    client = BatchClient(get_pool(chain_cfg), chain_cfg.get('rpc_batch_size', DEFAULT_BATCH_SIZE))
+    responses = client.call_many([('eth_getTransactionReceipt', [tx_hash]) for tx_hash in transaction_hashes])
+    return [format_receipt(unwrap(response)) for response in responses]
+
+
+def get_transactions(chain_cfg, transaction_hashes):
+    # Transactions as the node knows them, mined or waiting, None for the
+    # ones it never saw or dropped
+    client = BatchClient(get_pool(chain_cfg), chain_cfg.get('rpc_batch_size', DEFAULT_BATCH_SIZE))
+    responses = client.call_many([('eth_getTransactionByHash', [tx_hash]) for tx_hash in transaction_hashes])
+    return [unwrap(response) for response in responses]
+
+
+# A send that failed on one endpoint may still have reached the node, sending
+# it again elsewhere could replace or duplicate the transaction
+NOT_RETRIED = frozenset({'eth_sendRawTransaction', 'eth_sendTransaction'})
+
+
+class PooledProvider(JSONBaseProvider):
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        retries = 0 if method in NOT_RETRIED else None
+        raw_response = self.pool.post(request_data, methods=(method,), retries=retries)
+        return self.decode_rpc_response(raw_response)
+
+
+def endpoints_from_config(chain_cfg):
+    # rpc_urls entries are plain URLs or {url, weight, rps}, rpc_url is the
+    # single-endpoint shorthand
+    entries = chain_cfg.get('rpc_urls') or [chain_cfg['rpc_url']]
+    endpoints = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {'url': entry}
+        endpoints.append(Endpoint(
+            entry['url'],
+            weight=entry.get('weight', 1.0),
+            rps=entry.get('rps'),
+            timeout=entry.get('timeout', 30),
+        ))
+    return endpoints
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(chain_cfg):
+    # One pool per chain and process, so every caller shares sessions and budgets
+    with pools_lock:
+        if chain_cfg['id'] not in pools:
+            pools[chain_cfg['id']] = RpcPool(
+                endpoints_from_config(chain_cfg),
+                max_retries=chain_cfg.get('rpc_retries', 5),
+                chain=chain_cfg['id'],
+            )
+        return pools[chain_cfg['id']]
+
+
+def make_web3(chain_cfg):
+    w3 = Web3(PooledProvider(get_pool(chain_cfg)))
+
+    # This line is necessary for some networks (like Rinkeby)
+    w3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    return w3
@@ -0,0 +1,154 @@
+"""Binary snapshot files.
+
+A 64-byte header followed by one 52-byte record per holder: the 20-byte
+address and its balance as a 32-byte big-endian integer. Records are sorted
+by address, so a memory-mapped file answers single holder lookups with a
+binary search and bulk reads are plain slicing, without parsing text.
+
+Header, big-endian: magic, format version, snapshot type (0 single,
+1 average), chain id, start block, end block (0 for single snapshots) and
+holder count, zero padded to 64 bytes.
+"""
+import argparse
+import csv
+import mmap
+import os
+import struct
+from eth_hash.auto import keccak
+
+MAGIC = b'ERC20SNP'
+VERSION = 1
+HEADER = struct.Struct('>8sHHQQQQ')
+HEADER_SIZE = 64
+ADDRESS_SIZE = 20
+BALANCE_SIZE = 32
+RECORD_SIZE = ADDRESS_SIZE + BALANCE_SIZE
+SNAPSHOT_TYPES = ('single', 'average')
+UPPERCASE_NIBBLES = frozenset('89abcdef')
+
+
+def hex_to_bytes(value):
+    return bytes.fromhex(value[2:] if value.startswith('0x') else value)
+
+
+def checksum_address(raw):
+    # EIP-55 without eth_utils' input validation, which dominates bulk reads
+    address = raw.hex()
+    digest = keccak(address.encode()).hex()
+    return '0x' + ''.join(c.upper() if d in UPPERCASE_NIBBLES else c for c, d in zip(address, digest))
+
+
+def write_snapshot(path, balances, chain_id, snapshot_type, start_block, end_block=None):
+    # Written next to the target and renamed over it, readers never see half a file
+    records = sorted((hex_to_bytes(holder), int(balance)) for holder, balance in balances.items())
+    header = HEADER.pack(
+        MAGIC, VERSION, SNAPSHOT_TYPES.index(snapshot_type),
+        chain_id, start_block, end_block or 0, len(records)
+    )
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(header.ljust(HEADER_SIZE, b'\0'))
+        file.write(b''.join(address + balance.to_bytes(BALANCE_SIZE, 'big') for address, balance in records))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+class SnapshotFile:
+    """Read-only view of a snapshot file through mmap."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            # mmap refuses empty files, and a header-only file has no records anyway
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        if len(self.data) < HEADER_SIZE:
+            raise Exception(f'{path} is not a snapshot file')
+        magic, version, snapshot_type, self.chain_id, self.start_block, end_block, self.count = \
+            HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f'{path} is not a version {VERSION} snapshot file')
+        if len(self.data) != HEADER_SIZE + self.count * RECORD_SIZE:
+            raise Exception(f'{path} is truncated')
+        self.snapshot_type = SNAPSHOT_TYPES[snapshot_type]
+        self.end_block = end_block or None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def address_at(self, index):
+        offset = HEADER_SIZE + index * RECORD_SIZE
+        return self.data[offset:offset + ADDRESS_SIZE]
+
+    def balance_at(self, index):
+        offset = HEADER_SIZE + index * RECORD_SIZE + ADDRESS_SIZE
+        return int.from_bytes(self.data[offset:offset + BALANCE_SIZE], 'big')
+
+    def get(self, holder, default=None):
+        # Binary search over the sorted addresses
+        target = hex_to_bytes(holder)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.address_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.address_at(low) == target:
+            return self.balance_at(low)
+        return default
+
+    def raw_items(self):
+        # (20-byte address, balance) pairs in address order
+        body = memoryview(self.data)[HEADER_SIZE:]
+        for offset in range(0, self.count * RECORD_SIZE, RECORD_SIZE):
+            yield (
+                bytes(body[offset:offset + ADDRESS_SIZE]),
+                int.from_bytes(body[offset + ADDRESS_SIZE:offset + RECORD_SIZE], 'big'),
+            )
+
+    def items(self):
+        for address, balance in self.raw_items():
+            yield checksum_address(address), balance
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+def export_csv(snapshot, path):
+    # Same layout as the CSV snapshots, largest holders first
+    with open(path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Address', 'Balance'])
+        for holder, balance in sorted(snapshot.items(), key=lambda x: x[1], reverse=True):
+            writer.writerow([holder, balance])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect a binary snapshot file.")
+    parser.add_argument('path', help="snapshot file")
+    parser.add_argument('--holder', action='append', default=[], help="print the balance of this address, repeatable")
+    parser.add_argument('--csv', help="export the snapshot to this CSV file")
+    args = parser.parse_args()
+
+    with SnapshotFile(args.path) as snapshot:
+        blocks = f"{snapshot.start_block}" + (f"-{snapshot.end_block}" if snapshot.end_block else '')
+        print(f"{snapshot.snapshot_type.capitalize()} snapshot of chain {snapshot.chain_id} at {blocks}, {len(snapshot)} holders")
+        for holder in args.holder:
+            print(f"{holder}: {snapshot.get(holder, 0)}")
+        if args.csv:
+            export_csv(snapshot, args.csv)
+            print(f"Exported to {args.csv}")
@@ -1,29 +1,54 @@
-from database import init_db, Event, Contract, Chain
-from collections import defaultdict
+from database import init_db, decode_value, load_addresses, Event, Contract, Chain
+from checkpoints import stream_events
+import checkpoints
+from snapfile import SnapshotFile, export_csv, write_snapshot
+from config import CONFIG_PATH, load_config
+from logs import log
+from metrics import SNAPSHOT_PHASE_SECONDS, instrumented
+from collections import defaultdict, deque
+from fractions import Fraction
 from tqdm import tqdm
+import argparse
 import csv
 import os
+import sys
 
-def check_snapshot_file(chain_id, contract_address, snapshot_type, start_block, end_block=None):
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+ENGINES = ('numpy', 'python')
+# numpy is optional and opt-in. Turning rows into arrays costs more than the
+# batched replay saves until a replay covers millions of events. It is only
+# imported once a snapshot is replayed with it.
+DEFAULT_ENGINE = 'python'
+
+def snapshot_filename(chain_id, contract_address, snapshot_type, start_block, end_block=None, extension='snap'):
     filename = f'snapshots/{chain_id}/{contract_address}/{snapshot_type}_snapshot_{start_block}'
     if end_block:
         filename += f'_{end_block}'
-    filename += '.csv'
+    return f'{filename}.{extension}'
 
-    if os.path.isfile(filename):
-        print(f"{snapshot_type.capitalize()} snapshot already exists in {filename}")
-        return True
-    else:
-        return False
+
+def check_snapshot_file(chain_id, contract_address, snapshot_type, start_block, end_block=None):
+    for extension in ('snap', 'csv'):
+        filename = snapshot_filename(chain_id, contract_address, snapshot_type, start_block, end_block, extension)
+        if os.path.isfile(filename):
+            log(f"{snapshot_type.capitalize()} snapshot already exists in {filename}", path=filename)
+            return True
+    return False
 
 
 def read_snapshot_file(chain_id, contract_address, snapshot_type, start_block, end_block=None):
-    filename = f'snapshots/{chain_id}/{contract_address}/{snapshot_type}_snapshot_{start_block}'
-    if end_block:
-        filename += f'_{end_block}'
-    filename += '.csv'
+    filename = snapshot_filename(chain_id, contract_address, snapshot_type, start_block, end_block)
+    if os.path.isfile(filename):
+        with SnapshotFile(filename) as snapshot:
+            return snapshot.to_dict()
 
+    # Snapshots written before the binary format
     balances = {}
+    filename = snapshot_filename(chain_id, contract_address, snapshot_type, start_block, end_block, 'csv')
     with open(filename, mode='r', newline='') as file:
         reader = csv.reader(file)
         next(reader)  # Skip header row
@@ -32,6 +57,15 @@ def read_snapshot_file(chain_id, contract_address, snapshot_type, start_block, e
 
     return balances
 
+def report_peak_memory():
+    if resource is None:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB everywhere else
+    peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    log(f"Peak memory: {peak_mb:.1f} MB", peak_mb=round(peak_mb, 1))
+
+
 def get_chain_and_contract():
     # Create a session to interact with the database
     Session = init_db()
@@ -59,72 +93,145 @@ def get_chain_and_contract():
     return chain, contract
 
 
+def write_snapshot_file(chain_id, contract_address, balances, snapshot_type, start_block, end_block=None, csv_export=False):
+    if not os.path.exists(f'snapshots/{chain_id}/{contract_address}'):
+        os.makedirs(f'snapshots/{chain_id}/{contract_address}')
+
+    filename = snapshot_filename(chain_id, contract_address, snapshot_type, start_block, end_block)
+    if os.path.exists(filename):
+        log("Snapshot file already exists. Not overwriting...", level='warning', path=filename)
+    else:
+        with SNAPSHOT_PHASE_SECONDS.time(phase='write'):
+            write_snapshot(filename, balances, chain_id, snapshot_type, start_block, end_block)
+        log(f"{snapshot_type.capitalize()} snapshot has been written to {filename}", path=filename)
+
+    if csv_export:
+        write_to_csv(chain_id, contract_address, balances, snapshot_type, start_block, end_block)
+
+
 def write_to_csv(chain_id, contract_address, balances, snapshot_type, start_block, end_block=None):
     if not os.path.exists(f'snapshots/{chain_id}/{contract_address}'):
         os.makedirs(f'snapshots/{chain_id}/{contract_address}')
     
-    filename = f'snapshots/{chain_id}/{contract_address}/{snapshot_type}_snapshot_{start_block}'
-    if end_block:
-        filename += f'_{end_block}'
-    filename += '.csv'
+    filename = snapshot_filename(chain_id, contract_address, snapshot_type, start_block, end_block, 'csv')
 
     if os.path.exists(filename):
-        print("Snapshot file already exists. Not overwriting...")
+        log("Snapshot file already exists. Not overwriting...", level='warning', path=filename)
         return
 
-    with open(filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Address', 'Balance'])
-        for holder, balance in sorted(balances.items(), key=lambda x: x[1], reverse=True):
-            writer.writerow([holder, int(balance)])  # Truncating the balance to the nearest integer
+    # Truncating the balances to the nearest integer
+    with SNAPSHOT_PHASE_SECONDS.time(phase='csv'):
+        export_csv({holder: int(balance) for holder, balance in balances.items()}, filename)
+
+    log(f"{snapshot_type.capitalize()} snapshot has been written to {filename}", path=filename)
 
-    print(f"{snapshot_type.capitalize()} snapshot has been written to {filename}")
 
+def with_addresses(db_session, balances):
+    with SNAPSHOT_PHASE_SECONDS.time(phase='addresses'):
+        addresses = load_addresses(db_session, balances.keys())
+    return {addresses[holder]: balance for holder, balance in balances.items()}
 
-def create_snapshot(chain_id, contract_address, block_height, db_session):
-    print(f"Creating snapshot for block {block_height}")
+
+def create_snapshot(chain_id, contract_address, block_height, db_session, engine=DEFAULT_ENGINE):
+    log(f"Creating snapshot for block {block_height}", block=block_height)
     contract = db_session.query(Contract).join(Chain).filter(
         Chain.id == chain_id,
         Contract.address == contract_address
     ).first()
 
     if not contract:
-        print(f"No contract found for chain {chain_id} and address {contract_address}")
+        log(f"No contract found for chain {chain_id} and address {contract_address}", level='error')
         return
 
-    events = db_session.query(Event).filter(
-        Event.contract_id == contract.id,
-        Event.block_number <= block_height
-    ).all()
+    with SNAPSHOT_PHASE_SECONDS.time(phase='replay'):
+        balances = replay_engine(engine).replay_balances(db_session, contract.id, block_height)
+
+    return with_addresses(db_session, balances)
+
+
+class TimeWeightedBalances:
+    """Running balances plus each holder's balance summed over blocks.
+
+    A holder is only touched when their balance changes: the blocks held
+    since the last change are settled at the old balance. integral(block)
+    closes out every holder's tail, giving the sum of their balance over
+    blocks origin + 1 to block.
+    """
+
+    def __init__(self, balances, origin):
+        self.balances = balances
+        self.origin = origin
+        self.totals = defaultdict(int)
+        self.settled = {}
 
-    balances = defaultdict(int)
-    for event in events:
-        balances[event.from_address] -= int(event.value)
-        balances[event.to_address] += int(event.value)
+    def apply(self, block_number, from_id, to_id, value):
+        value = decode_value(value)
+        for holder, delta in ((from_id, -value), (to_id, value)):
+            held_since = self.settled.get(holder, self.origin)
+            self.totals[holder] += self.balances[holder] * (block_number - 1 - held_since)
+            self.settled[holder] = block_number - 1
+            self.balances[holder] += delta
 
-    return {holder: balance for holder, balance in balances.items()}
+    def integral(self, block):
+        return {
+            holder: self.totals[holder] + balance * (block - self.settled.get(holder, self.origin))
+            for holder, balance in self.balances.items()
+        }
 
 
-def create_single_snapshot(chain_id, contract_address, block_height):
+def time_weighted_totals(balances, events, start_block, end_block):
+    """Sum each holder's balance over blocks start_block + 1 to end_block.
+
+    balances is the state after start_block and is updated in place, events
+    are (block_number, from_id, to_id, value) rows in block order.
+    """
+    replay = TimeWeightedBalances(balances, start_block)
+    for block_number, from_id, to_id, value in tqdm(events, desc="Processing events"):
+        replay.apply(block_number, from_id, to_id, value)
+    return replay.integral(end_block)
+
+
+def averages(totals, num_blocks, exact=False):
+    # exact keeps the average as a Fraction, floats lose precision on large balances
+    if exact:
+        return {holder: Fraction(balance, num_blocks) for holder, balance in totals.items() if balance > 0}
+    return {holder: balance / num_blocks for holder, balance in totals.items() if balance > 0}
+
+
+def replay_engine(engine):
+    # Module holding replay_balances for the engine
+    if engine not in ENGINES:
+        raise ValueError(f"unknown snapshot engine {engine}, expected one of {', '.join(ENGINES)}")
+    if engine == 'numpy':
+        try:
+            import balances_np
+        except ImportError:
+            raise ValueError("the numpy snapshot engine needs numpy installed")
+        return balances_np
+    return checkpoints
+
+
+def create_single_snapshot(chain_id, contract_address, block_height, engine=DEFAULT_ENGINE):
     if check_snapshot_file(chain_id, contract_address, 'single', block_height):
-        print("Snapshot already exists. Reading from file...")
+        log("Snapshot already exists. Reading from file...")
         return read_snapshot_file(chain_id, contract_address, 'single', block_height)
     else:
         Session = init_db()
         session = Session()
 
-        balances = create_snapshot(chain_id, contract_address, block_height, session)
+        balances = create_snapshot(chain_id, contract_address, block_height, session, engine)
 
         balances = {holder: balance for holder, balance in balances.items() if balance > 0}
 
         session.close()
+        report_peak_memory()
 
         return {holder: balance for holder, balance in balances.items() if balance > 0}
 
 
-def create_average_snapshot(chain_id, contract_address, start_block, end_block):
+def create_average_snapshot(chain_id, contract_address, start_block, end_block, exact=False, engine=DEFAULT_ENGINE):
     if check_snapshot_file(chain_id, contract_address,'average', start_block, end_block):
-        print("Snapshot already exists. Reading from file...")
+        log("Snapshot already exists. Reading from file...")
         return read_snapshot_file(chain_id, contract_address,'average', start_block, end_block)
     else:
         Session = init_db()
@@ -136,55 +243,172 @@ def create_average_snapshot(chain_id, contract_address, start_block, end_block):
         ).first()
 
         if not contract:
-            print(f"No contract found for chain {chain_id} and address {contract_address}")
+            log(f"No contract found for chain {chain_id} and address {contract_address}", level='error')
             return
 
         # Get snapshot for the start block
-        balances = create_snapshot(chain_id, contract_address, start_block, session)
-
-        events = session.query(Event).filter(
-            Event.contract_id == contract.id,
-            Event.block_number > start_block,
-            Event.block_number <= end_block
-        ).order_by(Event.block_number).all()
+        log(f"Creating snapshot for block {start_block}", block=start_block)
+        engine_module = replay_engine(engine)
+        with SNAPSHOT_PHASE_SECONDS.time(phase='replay'):
+            balances = engine_module.replay_balances(session, contract.id, start_block)
 
-        total_balances = defaultdict(int)
         num_blocks = end_block - start_block
 
-        print(f"Processing {len(events)} events...")
-        current_block = start_block
-        event_idx = 0
+        with SNAPSHOT_PHASE_SECONDS.time(phase='events'):
+            if engine == 'numpy':
+                batches = engine_module.event_batches(session, contract.id, start_block, end_block)
+                total_balances = engine_module.time_weighted_totals(balances, batches, start_block, end_block)
+            else:
+                events = stream_events(
+                    session, contract.id, start_block, end_block,
+                    (Event.block_number, Event.from_id, Event.to_id, Event.value)
+                )
+                total_balances = time_weighted_totals(balances, events, start_block, end_block)
 
-        for block_number in tqdm(range(start_block + 1, end_block + 1), desc="Processing blocks"):
-            while event_idx < len(events) and events[event_idx].block_number == block_number:
-                event = events[event_idx]
-                balances[event.from_address] = balances.get(event.from_address, 0) - int(event.value)
-                balances[event.to_address] = balances.get(event.to_address, 0) + int(event.value)
-                event_idx += 1
-            
-            # Increment the total balance for this block
-            for holder, balance in balances.items():
-                total_balances[holder] += balance
+        average_balances = averages(total_balances, num_blocks, exact)
+        average_balances = with_addresses(session, average_balances)
 
-        average_balances = {holder: balance / num_blocks for holder, balance in total_balances.items() if balance > 0}
+        session.close()
+        report_peak_memory()
+
+        return average_balances
+
+
+def create_snapshots(chain_id, contract_address, heights=(), windows=(), exact=False, engine=DEFAULT_ENGINE):
+    """Build several snapshots of one contract in a single pass over its events.
+
+    heights are block heights for single snapshots and windows are
+    (start_block, end_block) pairs for average snapshots. Returns
+    {'single': {height: balances}, 'average': {(start, end): balances}}.
+    """
+    heights = sorted(set(heights))
+    windows = sorted(set(windows))
+    boundaries = sorted({block for window in windows for block in window})
+    marks = sorted(set(heights) | set(boundaries))
+    if not marks:
+        return {'single': {}, 'average': {}}
+
+    Session = init_db()
+    session = Session()
 
+    contract = session.query(Contract).join(Chain).filter(
+        Chain.id == chain_id,
+        Contract.address == contract_address
+    ).first()
+
+    if not contract:
+        log(f"No contract found for chain {chain_id} and address {contract_address}", level='error')
         session.close()
+        return
 
-        return {holder: balance / num_blocks for holder, balance in total_balances.items() if balance > 0}
+    origin = marks[0]
+    log(f"Creating {len(heights)} single and {len(windows)} average snapshots from block {origin}", block=origin)
+    engine_module = replay_engine(engine)
+    with SNAPSHOT_PHASE_SECONDS.time(phase='replay'):
+        balances = engine_module.replay_balances(session, contract.id, origin)
+    if engine == 'numpy':
+        replay = engine_module.LimbBalances(dict(balances), origin)
+    else:
+        replay = TimeWeightedBalances(balances, origin)
+
+    single = {}
+    integrals = {}
+
+    def record(block):
+        # Called once every event up to and including block has been applied
+        if block in heights:
+            single[block] = {holder: balance for holder, balance in replay.balances.items() if balance > 0}
+        if block in boundaries:
+            integrals[block] = replay.integral(block)
+
+    with SNAPSHOT_PHASE_SECONDS.time(phase='events'):
+        if engine == 'numpy':
+            batches = engine_module.event_batches(session, contract.id, origin, marks[-1])
+            replay.replay(tqdm(batches, desc="Processing event batches"), marks, record)
+        else:
+            events = stream_events(
+                session, contract.id, origin, marks[-1],
+                (Event.block_number, Event.from_id, Event.to_id, Event.value)
+            )
+
+            pending = deque(marks)
+            for block_number, from_id, to_id, value in tqdm(events, desc="Processing events"):
+                while pending and pending[0] < block_number:
+                    record(pending.popleft())
+                replay.apply(block_number, from_id, to_id, value)
+            while pending:
+                record(pending.popleft())
+
+    average = {}
+    for start_block, end_block in windows:
+        start, end = integrals[start_block], integrals[end_block]
+        totals = {holder: total - start.get(holder, 0) for holder, total in end.items()}
+        average[(start_block, end_block)] = averages(totals, end_block - start_block, exact)
+
+    holder_ids = set()
+    for balances in list(single.values()) + list(average.values()):
+        holder_ids.update(balances)
+    with SNAPSHOT_PHASE_SECONDS.time(phase='addresses'):
+        addresses = load_addresses(session, holder_ids)
 
+    session.close()
+    report_peak_memory()
+
+    return {
+        'single': {
+            height: {addresses[holder]: balance for holder, balance in balances.items()}
+            for height, balances in single.items()
+        },
+        'average': {
+            window: {addresses[holder]: balance for holder, balance in balances.items()}
+            for window, balances in average.items()
+        },
+    }
+
+
+def block_window(text):
+    # START:END of --window, argparse reports the error with the usage
+    try:
+        start_block, end_block = (int(block) for block in text.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected START:END block numbers, got {text!r}")
+    if not 0 <= start_block < end_block:
+        raise argparse.ArgumentTypeError(f"START must be at least 0 and below END, got {text!r}")
+    return start_block, end_block
+
+
+def run_batch(args):
+    # Snapshots already on disk are not computed again
+    heights = [height for height in args.height
+               if not check_snapshot_file(args.chain, args.contract, 'single', height)]
+    windows = []
+    for start_block, end_block in args.window:
+        if not check_snapshot_file(args.chain, args.contract, 'average', start_block, end_block):
+            windows.append((start_block, end_block))
+
+    results = create_snapshots(args.chain, args.contract, heights, windows, exact=args.exact, engine=args.engine)
+    if results is None:
+        return
 
-if __name__ == "__main__":
+    for height, balances in results['single'].items():
+        write_snapshot_file(args.chain, args.contract, balances, 'single', height, csv_export=args.csv)
+    for (start_block, end_block), balances in results['average'].items():
+        write_snapshot_file(args.chain, args.contract, balances, 'average', start_block, end_block, csv_export=args.csv)
+
+
+def run_interactive():
     # Prompt user to select chain and contract
     chain, contract = get_chain_and_contract()
 
     # Ask user which snapshot they want to create
     snapshot_choice = input("Do you want to create a single snapshot (S) or average snapshot (A)? ").strip().upper()
+    csv_export = input("Also export the snapshot as CSV? (y/N) ").strip().upper() == 'Y'
 
     if snapshot_choice == 'S':
         block_height = int(input(f"\nEnter the block height for the single snapshot (current: {contract.last_processed_block}): "))
         # Create the single snapshot
         balances = create_single_snapshot(chain_id=chain.id, contract_address=contract.address, block_height=block_height)
-        write_to_csv(chain.id, contract.address, balances, 'single', block_height)
+        write_snapshot_file(chain.id, contract.address, balances, 'single', block_height, csv_export=csv_export)
     elif snapshot_choice == 'A':
         start_block = int(input(f"\nEnter the start block height for the average snapshot (current: {contract.last_processed_block}): "))
         end_block = int(input(f"Enter the end block height for the average snapshot (current: {contract.last_processed_block}): "))
@@ -193,6 +417,30 @@ if __name__ == "__main__":
         if(end_block > contract.last_processed_block):
             end_block = contract.last_processed_block
         balances = create_average_snapshot(chain_id=chain.id, contract_address=contract.address, start_block=start_block, end_block=end_block)
-        write_to_csv(chain.id, contract.address, balances, 'average', start_block, end_block)
+        write_snapshot_file(chain.id, contract.address, balances, 'average', start_block, end_block, csv_export=csv_export)
     else:
         print("Invalid choice. Please enter 'S' for single snapshot or 'A' for average snapshot.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create token balance snapshots. Prompts for everything when run without arguments.")
+    parser.add_argument('--chain', type=int, help="chain id")
+    parser.add_argument('--contract', help="contract address, as stored by the indexer")
+    parser.add_argument('--height', type=int, action='append', default=[], help="block height of a single snapshot, repeatable")
+    parser.add_argument('--window', type=block_window, action='append', default=[], help="START:END blocks of an average snapshot, repeatable")
+    parser.add_argument('--exact', action='store_true', help="keep averages as exact fractions")
+    parser.add_argument('--csv', action='store_true', help="also write each snapshot as CSV")
+    parser.add_argument('--engine', choices=ENGINES, default=DEFAULT_ENGINE,
+                        help=f"balance replay engine (default: {DEFAULT_ENGINE})")
+    parser.add_argument('--profile', help="write cProfile stats of the run to this file")
+    args = parser.parse_args()
+
+    # Snapshots only need the database, config.yml is read for the metrics settings if present
+    cfg = load_config() if os.path.exists(CONFIG_PATH) else {}
+    with instrumented(cfg or {}, args.profile):
+        if args.chain is None and args.contract is None:
+            run_interactive()
+        elif args.chain is None or args.contract is None or not (args.height or args.window):
+            parser.error("--chain and --contract need at least one --height or --window")
+        else:
+            run_batch(args)
@@ -0,0 +1,186 @@
+import time
+from collections import deque
+from web3 import Web3
+from logs import log
+from metrics import AIRDROP_CONFIRMATION_SECONDS, AIRDROP_IN_FLIGHT, AIRDROP_REPLACEMENTS, AIRDROP_TRANSACTIONS
+from rpc import get_receipts
+
+
+class PipelinedSender:
+    """Sends transactions from one account with consecutive nonces, several at a time.
+
+    Up to max_in_flight transactions wait for their receipts together, and
+    the receipts of all of them are polled in one batched request. A
+    transaction without a receipt after replace_after seconds is sent again
+    at the same nonce with a higher gas price. After max_replacements of
+    those its nonce is filled with a zero-value transfer to self instead, so
+    the transactions behind it are not stuck behind a gap. A nonce that was
+    mined while none of its hashes gets a receipt within another
+    replace_after seconds went to a transaction this sender does not know,
+    and its job fails.
+
+    run() reports every job through on_result(key, status, tx_hash), with
+    status 'pending' for every transaction about to be sent for it, the
+    replacements too, and then 'success' or 'failed'. A job whose nonce was
+    filled by the cancellation fails without a hash, the cancellation is not
+    one of its transactions.
+
+    The gas price is fetched at most once per gas_price_ttl seconds and
+    shared by every transaction sent in between.
+    """
+
+    def __init__(self, w3, chain_cfg, account, private_key, max_in_flight=8, poll_interval=2.0,
+                 replace_after=180.0, max_replacements=3, gas_bump=1.125, gas_price_ttl=60.0):
+        self.w3 = w3
+        self.chain_cfg = chain_cfg
+        self.account = account
+        self.private_key = private_key
+        self.max_in_flight = max(1, max_in_flight)
+        self.poll_interval = poll_interval
+        self.replace_after = replace_after
+        self.max_replacements = max_replacements
+        self.gas_bump = gas_bump
+        self.gas_price_ttl = gas_price_ttl
+        self.cached_gas_price = None
+        self.gas_price_at = 0.0
+        # Start behind whatever this account already has in the mempool
+        self.nonce = w3.eth.get_transaction_count(account, 'pending')
+        self.in_flight = {}
+        self.chain = chain_cfg['id']
+
+    def gas_price(self):
+        if self.cached_gas_price is None or time.monotonic() - self.gas_price_at >= self.gas_price_ttl:
+            self.cached_gas_price = self.w3.eth.gas_price
+            self.gas_price_at = time.monotonic()
+        return self.cached_gas_price
+
+    def sign(self, txn):
+        # The hash is known before sending, so it can be journaled first
+        signed = self.w3.eth.account.sign_transaction(txn, self.private_key)
+        # eth-account 0.13 renamed rawTransaction
+        raw = signed.raw_transaction if hasattr(signed, 'raw_transaction') else signed.rawTransaction
+        return Web3.to_hex(signed.hash), raw
+
+    def run(self, jobs, build, on_result):
+        """Send every job in order. build(key, nonce, gas_price) returns the unsigned transaction."""
+        jobs = deque(jobs)
+        while jobs or self.in_flight:
+            while jobs and len(self.in_flight) < self.max_in_flight:
+                key = jobs.popleft()
+                try:
+                    txn = build(key, self.nonce, self.gas_price())
+                    tx_hash, raw = self.sign(txn)
+                except Exception as exc:
+                    log(f"Failed to build transaction at nonce {self.nonce}: {exc}", level='error', nonce=self.nonce)
+                    self.finish(key, 'failed', None, on_result)
+                    continue
+
+                on_result(key, 'pending', tx_hash)
+                try:
+                    self.w3.eth.send_raw_transaction(raw)
+                except Exception as exc:
+                    # A timeout can come after the node took the transaction,
+                    # only a pending count still at this nonce means it did not
+                    if self.w3.eth.get_transaction_count(self.account, 'pending') <= self.nonce:
+                        log(f"Failed to send transaction at nonce {self.nonce}: {exc}", level='error', nonce=self.nonce)
+                        self.finish(key, 'failed', None, on_result)
+                        continue
+                    log(
+                        f"Sending at nonce {self.nonce} failed but the node has the transaction: {exc}",
+                        level='warning', tx_hash=tx_hash, nonce=self.nonce
+                    )
+
+                log(f"Sent transaction {tx_hash} at nonce {self.nonce}", tx_hash=tx_hash, nonce=self.nonce)
+                self.in_flight[self.nonce] = {
+                    'key': key,
+                    'txn': txn,
+                    'hashes': {tx_hash: 'job'},
+                    'first_sent': time.monotonic(),
+                    'sent': time.monotonic(),
+                    'replacements': 0,
+                }
+                AIRDROP_IN_FLIGHT.set(len(self.in_flight), chain=self.chain)
+                self.nonce += 1
+
+            if self.in_flight:
+                time.sleep(self.poll_interval)
+                self.poll(on_result)
+
+    def finish(self, key, status, tx_hash, on_result):
+        AIRDROP_TRANSACTIONS.inc(chain=self.chain, status=status)
+        on_result(key, status, tx_hash)
+
+    def poll(self, on_result):
+        sent = [(nonce, tx_hash) for nonce, entry in self.in_flight.items() for tx_hash in entry['hashes']]
+        receipts = get_receipts(self.chain_cfg, [tx_hash for _, tx_hash in sent])
+
+        for (nonce, tx_hash), receipt in zip(sent, receipts):
+            if receipt is None or nonce not in self.in_flight:
+                continue
+            entry = self.in_flight.pop(nonce)
+            AIRDROP_IN_FLIGHT.set(len(self.in_flight), chain=self.chain)
+            AIRDROP_CONFIRMATION_SECONDS.observe(time.monotonic() - entry['first_sent'], chain=self.chain)
+            if entry['hashes'][tx_hash] == 'cancel':
+                log(f"Nonce {nonce} was filled by a cancellation, job dropped", level='warning', tx_hash=tx_hash, nonce=nonce)
+                self.finish(entry['key'], 'failed', None, on_result)
+            elif receipt['status'] == 1:
+                log(f"Transaction {tx_hash} successful", tx_hash=tx_hash, nonce=nonce)
+                self.finish(entry['key'], 'success', tx_hash, on_result)
+            else:
+                log(f"Transaction {tx_hash} failed", level='error', tx_hash=tx_hash, nonce=nonce)
+                self.finish(entry['key'], 'failed', tx_hash, on_result)
+
+        now = time.monotonic()
+        stuck = sorted(nonce for nonce, entry in self.in_flight.items() if now - entry['sent'] >= self.replace_after)
+        if stuck:
+            mined = self.w3.eth.get_transaction_count(self.account)
+            for nonce in stuck:
+                if nonce >= mined:
+                    self.replace(nonce, on_result)
+                    continue
+                # Below the mined count one of the hashes usually made it and
+                # its receipt shows up on a later poll
+                entry = self.in_flight[nonce]
+                entry.setdefault('mined_at', now)
+                if now - entry['mined_at'] >= self.replace_after:
+                    del self.in_flight[nonce]
+                    AIRDROP_IN_FLIGHT.set(len(self.in_flight), chain=self.chain)
+                    log(
+                        f"Nonce {nonce} was used by an unknown transaction, job dropped",
+                        level='error', nonce=nonce
+                    )
+                    self.finish(entry['key'], 'failed', None, on_result)
+
+    def replace(self, nonce, on_result):
+        entry = self.in_flight[nonce]
+        txn = dict(entry['txn'])
+        txn['gasPrice'] = max(int(txn['gasPrice'] * self.gas_bump) + 1, self.gas_price())
+        kind = 'job'
+        if entry['replacements'] >= self.max_replacements:
+            txn = {
+                'chainId': txn['chainId'],
+                'nonce': nonce,
+                'to': self.account,
+                'value': 0,
+                'gas': 21000,
+                'gasPrice': txn['gasPrice'],
+            }
+            kind = 'cancel'
+
+        tx_hash, raw = self.sign(txn)
+        if kind == 'job':
+            on_result(entry['key'], 'pending', tx_hash)
+        # Polled even if sending raises, the node may have taken it anyway
+        entry['hashes'][tx_hash] = kind
+        entry['sent'] = time.monotonic()
+        try:
+            self.w3.eth.send_raw_transaction(raw)
+        except Exception as exc:
+            # Typically the original got mined in the meantime, try again later
+            log(f"Failed to replace transaction at nonce {nonce}: {exc}", level='warning', nonce=nonce)
+            return
+
+        log(f"Replaced transaction at nonce {nonce} with {tx_hash} ({kind})", tx_hash=tx_hash, nonce=nonce, kind=kind)
+        AIRDROP_REPLACEMENTS.inc(chain=self.chain, kind=kind)
+        entry['replacements'] += 1
+        entry['txn'] = txn
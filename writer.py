@@ -0,0 +1,198 @@
+"""Database side of the indexer.
+
+IndexWriter applies everything the indexer writes, one window per
+transaction. In a single process the chains call it directly. With
+`indexer.py --processes` it runs in a writer process of its own and the chain
+workers send it windows over a queue, so exactly one connection writes to
+SQLite while the workers fetch and decode on the other cores.
+"""
+import asyncio
+import itertools
+import pickle
+import threading
+from database import init_db, bulk_insert_events, encode_value, AddressBook, BlockHash, ChunkSize, Contract
+from checkpoints import checkpoint_progress, invalidate_checkpoints, maybe_checkpoint
+from config import load_config
+from logcache import LogCache
+from logs import log
+from reorg import ReorgDetected, rollback
+
+
+class IndexWriter:
+    def __init__(self, db_session, log_cache_dir=None):
+        self.db_session = db_session
+        self.address_book = AddressBook()
+        self.log_cache_dir = log_cache_dir
+        self.log_caches = {}
+        # contract id -> (last checkpoint block, events stored since), read
+        # once per contract and then carried along with every window
+        self.checkpoints = {}
+
+    def log_cache(self, chain_id):
+        # The writer is the only one appending, so it repairs torn records
+        if chain_id not in self.log_caches:
+            self.log_caches[chain_id] = LogCache(self.log_cache_dir, chain_id, repair=True)
+        return self.log_caches[chain_id]
+
+    def store_events(self, contract_id, events, start_block, end_block):
+        # Insert events and move the cursor in the same transaction, the caller commits
+        db_contract = self.db_session.get(Contract, contract_id)
+        if db_contract.last_processed_block != start_block - 1:
+            raise ReorgDetected(f"{db_contract.address} was rolled back below block {start_block}")
+
+        invalidate_checkpoints(self.db_session, contract_id, start_block)
+
+        address_ids = self.address_book.resolve(
+            self.db_session,
+            {event[2] for event in events} | {event[3] for event in events}
+        )
+        rows = [
+            {
+                'contract_id': contract_id,
+                'block_number': block_number,
+                'log_index': log_index,
+                'from_id': address_ids[sender],
+                'to_id': address_ids[receiver],
+                'value': encode_value(value),
+                'transaction_hash': transaction_hash,
+            }
+            for block_number, log_index, sender, receiver, value, transaction_hash in events
+        ]
+        inserted = bulk_insert_events(self.db_session, rows)
+
+        db_contract.last_processed_block = end_block
+        return inserted
+
+    def store_window(self, chain_id, start_block, end_block, batches, block_hashes, chunk_key, chunk_size,
+                     checkpoint_every, cache_records=()):
+        """Commit one window of one or more contracts of a chain.
+
+        batches holds (contract_id, events) pairs with events as
+        (block_number, log_index, from, to, value, transaction_hash) tuples.
+        cache_records are the raw logs the window was decoded from, appended
+        to the log cache once the window is committed. Returns the number of
+        events stored.
+        """
+        try:
+            rows = 0
+            progress = {}
+            for contract_id, events in batches:
+                last_block, stored = self.checkpoints.get(contract_id) or \
+                    checkpoint_progress(self.db_session, contract_id, start_block - 1)
+                count = self.store_events(contract_id, events, start_block, end_block)
+                rows += count
+                progress[contract_id] = maybe_checkpoint(
+                    self.db_session, contract_id, end_block, *checkpoint_every, last_block, stored + count
+                )
+            for block_number, block_hash in block_hashes:
+                self.db_session.merge(BlockHash(chain_id=chain_id, block_number=block_number, hash=block_hash))
+            self.db_session.merge(ChunkSize(chain_id=chain_id, contract_id=chunk_key, size=chunk_size))
+            self.db_session.commit()
+        except Exception:
+            self.db_session.rollback()
+            self.address_book.clear()
+            raise
+        self.checkpoints.update(progress)
+        if cache_records and self.log_cache_dir:
+            try:
+                self.log_cache(chain_id).write(cache_records)
+            except OSError as exc:
+                # The window is committed either way, the cache only misses it
+                log(f"Could not write the log cache: {exc}", level='warning', chain=chain_id)
+        return rows
+
+    def prune_hashes(self, chain_id, below_block):
+        self.db_session.query(BlockHash).filter(
+            BlockHash.chain_id == chain_id,
+            BlockHash.block_number < below_block
+        ).delete(synchronize_session=False)
+        self.db_session.commit()
+
+    def rollback(self, chain_id, fork_block):
+        if self.log_cache_dir:
+            # Cache first, a crash in between then leaves it short rather than stale
+            addresses = [address for address, in self.db_session.query(Contract.address).filter(
+                Contract.chain_id == chain_id,
+                Contract.last_processed_block > fork_block
+            )]
+            self.log_cache(chain_id).discard_after(addresses, fork_block)
+        rollback(self.db_session, chain_id, fork_block)
+        # Counts of rolled back contracts are read again
+        self.checkpoints.clear()
+
+
+class LocalWriter:
+    """Calls an IndexWriter in the caller's process."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    async def call(self, op, *args):
+        return getattr(self.writer, op)(*args)
+
+
+class RemoteWriter:
+    """Sends calls to the writer process and awaits their replies.
+
+    A thread waits on this worker's reply queue and hands each reply to the
+    event loop, so the worker keeps fetching while its windows are written.
+    """
+
+    def __init__(self, requests, replies, worker_id):
+        self.requests = requests
+        self.replies = replies
+        self.worker_id = worker_id
+        self.ids = itertools.count()
+        self.waiting = {}
+        self.loop = None
+
+    def listen(self):
+        while True:
+            call_id, ok, value = self.replies.get()
+            self.loop.call_soon_threadsafe(self.resolve, self.waiting.pop(call_id), ok, value)
+
+    @staticmethod
+    def resolve(future, ok, value):
+        if future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    async def call(self, op, *args):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            threading.Thread(target=self.listen, daemon=True).start()
+
+        call_id = next(self.ids)
+        future = self.loop.create_future()
+        self.waiting[call_id] = future
+        self.requests.put((self.worker_id, call_id, op, args))
+        return await future
+
+
+def portable(exc):
+    # Not every exception survives the trip back to the worker
+    try:
+        pickle.loads(pickle.dumps(exc))
+        return exc
+    except Exception:
+        return Exception(f"{type(exc).__name__}: {exc}")
+
+
+def serve(requests, replies):
+    # Writer process: apply calls in arrival order until a None arrives
+    Session = init_db(write_heavy=True)
+    writer = IndexWriter(Session(), load_config().get('log_cache_dir'))
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        worker_id, call_id, op, args = message
+        try:
+            reply = (call_id, True, getattr(writer, op)(*args))
+        except Exception as exc:
+            reply = (call_id, False, portable(exc))
+        replies[worker_id].put(reply)
+    writer.db_session.close()